@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+上传路径基准测试：在本地 Notion 替身（fake_notion.py）上驱动 upload_single_file / upload_dir，
+离线测量吞吐、单任务延迟（p50/p99）和峰值内存，用于发现上传路径的性能回退。
+
+测试矩阵：
+  - 单文件：不同大小（跨越 SINGLE_LIMIT，覆盖单块和分块上传）× 分块并发数 PART_CONCURRENCY
+  - 相册：不同文件数 × 相册内并发数 ALBUM_CONCURRENCY
+
+用法:
+  python benchmarks/bench_upload.py                       # 默认矩阵
+  python benchmarks/bench_upload.py --quick               # 小矩阵，快速冒烟
+  python benchmarks/bench_upload.py --sizes 1,25,100 --albums 10,50 --concurrency 1,4,8 \\
+      --latency 0.05 --bandwidth 50 --throttle-rate 0.02 --json bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent / "notion_uploader_data"))
+os.environ.setdefault("NOTION_TOKEN", "bench-token")
+os.environ.setdefault("NOTION_DATABASE_ID", "bench-db")
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MB = 1024 * 1024
+
+
+# ── 测量工具 ──────────────────────────
+def current_rss() -> int:
+    """当前进程常驻内存（字节）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    return 0
+
+
+class RssSampler:
+    """后台按固定间隔采样 RSS，记录区间内的峰值"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, current_rss())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, max(0, math.ceil(q / 100 * len(s)) - 1))]
+
+
+def write_file(path: Path, size: int, seed: int):
+    """生成指定大小的测试文件；每个文件内容不同，避免命中去重索引"""
+    block = os.urandom(MB - 16) + seed.to_bytes(16, "little")
+    with open(path, "wb") as f:
+        left = size
+        while left > 0:
+            n = min(left, len(block))
+            f.write(block[:n])
+            left -= n
+
+
+# ── 替身服务 ──────────────────────────
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_fake(args, port: int):
+    """在独立进程中启动替身服务，避免其内存计入被测进程"""
+    cmd = [sys.executable, str(HERE / "fake_notion.py"), "--port", str(port),
+           "--latency", str(args.latency), "--bandwidth", str(args.bandwidth),
+           "--error-rate", str(args.error_rate), "--throttle-rate", str(args.throttle_rate),
+           "--retry-after", str(args.retry_after), "--seed", "1"]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", port)
+            w.close()
+            return proc
+        except OSError:
+            await asyncio.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("替身服务启动失败")
+
+
+async def fake_stats(port: int) -> dict:
+    async with aiohttp.ClientSession() as s:
+        async with s.get(f"http://127.0.0.1:{port}/_stats") as r:
+            return await r.json()
+
+
+# ── 测试用例 ──────────────────────────
+async def run_case(nu, port, workdir: Path, kind: str, size_mb: float, n_files: int, conc: int, reps: int):
+    """执行一个用例 reps 次（串行），返回结果字典"""
+    if kind == "file":
+        nu.PART_CONCURRENCY = conc
+    else:
+        nu.ALBUM_CONCURRENCY = conc
+    size = int(size_mb * MB)
+
+    # 先生成全部输入，避免写盘时间计入延迟
+    jobs = []
+    for r in range(reps):
+        if kind == "file":
+            p = workdir / f"file_{r}.bin"
+            write_file(p, size, r)
+        else:
+            p = workdir / f"album_{r}"
+            p.mkdir()
+            for i in range(n_files):
+                write_file(p / f"{i:03d}.jpg", size, r * 1000 + i)
+        jobs.append(p)
+
+    before = await fake_stats(port)
+    latencies, failed = [], 0
+    with RssSampler() as rss:
+        t0 = time.monotonic()
+        for p in jobs:
+            t = time.monotonic()
+            if kind == "file":
+                await nu.upload_single_file(p)
+            else:
+                await nu.upload_dir_with_retry(p)
+            latencies.append(time.monotonic() - t)
+            if p.exists():
+                failed += 1
+                shutil.rmtree(p, ignore_errors=True) if p.is_dir() else p.unlink()
+        wall = time.monotonic() - t0
+    after = await fake_stats(port)
+
+    total = size * reps * (1 if kind == "file" else n_files)
+    return {
+        "case": f"{kind} {size_mb:g}MB" + ("" if kind == "file" else f" x{n_files}") + f" c={conc}",
+        "kind": kind, "size_mb": size_mb, "files": n_files, "concurrency": conc, "reps": reps,
+        "mb": total / MB,
+        "mb_s": total / MB / wall if wall else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p99_s": percentile(latencies, 99),
+        "peak_rss_mb": rss.peak / MB,
+        "requests": sum(after.get(k, 0) - before.get(k, 0)
+                        for k in ("create", "send", "complete", "create_page", "update_page", "append")),
+        "throttled": after.get("throttled", 0) - before.get("throttled", 0),
+        "errors": after.get("errors", 0) - before.get("errors", 0),
+        "failed": failed,
+    }
+
+
+def build_matrix(args):
+    cases = []
+    for conc in args.concurrency:
+        for s in args.sizes:
+            cases.append(("file", s, 1, conc))
+        for n in args.albums:
+            cases.append(("album", args.album_file_mb, n, conc))
+    return cases
+
+
+def print_row(r):
+    print(f"{r['case']:<28} {r['mb']:>9.1f} {r['mb_s']:>9.2f} {r['p50_s']:>8.3f} {r['p99_s']:>8.3f} "
+          f"{r['peak_rss_mb']:>9.1f} {r['requests']:>6} {r['throttled']:>5} {r['errors']:>5} {r['failed']:>5}",
+          flush=True)
+
+
+async def main(args):
+    port = free_port()
+    workdir = Path(tempfile.mkdtemp(prefix="notion_bench_"))
+    os.environ["WATCH_DIR"] = str(workdir)
+    import notion_uploader as nu
+    import logging
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    nu.NOTION_API = f"http://127.0.0.1:{port}/v1"
+    for acc in nu.accounts:
+        acc.limiter = nu.RateLimiter(args.rps, max(1, int(args.rps * 2)))
+    nu._backoff = lambda attempt: min(2.0, 0.1 * 2 ** attempt)  # 缩短重试等待，基准测试不需要等满
+    proc = await start_fake(args, port)
+    await nu.open_http()
+    results = []
+    try:
+        print(f"{'case':<28} {'MB':>9} {'MB/s':>9} {'p50 s':>8} {'p99 s':>8} {'RSS MB':>9} "
+              f"{'reqs':>6} {'429':>5} {'5xx':>5} {'fail':>5}")
+        for kind, size, n, conc in build_matrix(args):
+            r = await run_case(nu, port, workdir, kind, size, n, conc, args.reps)
+            results.append(r)
+            print_row(r)
+    finally:
+        await nu.close_http()
+        proc.terminate()
+        await proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2, ensure_ascii=False))
+        print(f"结果已写入 {args.json}")
+
+
+def parse_args(argv=None):
+    floats = lambda s: [float(x) for x in s.split(",") if x]
+    ints = lambda s: [int(x) for x in s.split(",") if x]
+    p = argparse.ArgumentParser(description="notion_uploader 上传路径基准测试")
+    p.add_argument("--sizes", type=floats, default=[1, 15, 25, 100], help="单文件大小（MB），逗号分隔")
+    p.add_argument("--albums", type=ints, default=[1, 10, 50], help="相册文件数，逗号分隔")
+    p.add_argument("--album-file-mb", type=float, default=2, help="相册中每个文件的大小（MB）")
+    p.add_argument("--concurrency", type=ints, default=[1, 4, 8], help="分块/相册内并发数，逗号分隔")
+    p.add_argument("--reps", type=int, default=3, help="每个用例重复次数")
+    p.add_argument("--rps", type=float, default=1000, help="客户端限速（次/秒），默认不限制以测量上传路径本身")
+    p.add_argument("--latency", type=float, default=0.02, help="替身服务每个请求的延迟（秒）")
+    p.add_argument("--bandwidth", type=float, default=0, help="替身服务共享带宽（MB/s），0 表示不限")
+    p.add_argument("--error-rate", type=float, default=0.0, help="注入 503 的概率")
+    p.add_argument("--throttle-rate", type=float, default=0.0, help="注入 429 的概率")
+    p.add_argument("--retry-after", type=float, default=0.2, help="429 响应的 Retry-After（秒）")
+    p.add_argument("--json", help="把结果写入 JSON 文件")
+    p.add_argument("--quick", action="store_true", help="小矩阵快速运行")
+    p.add_argument("-v", "--verbose", action="store_true", help="显示上传器日志")
+    args = p.parse_args(argv)
+    if args.quick:
+        args.sizes, args.albums, args.concurrency, args.reps = [1, 25], [5], [1, 4], 2
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+本地 Notion 文件上传 API 替身，用于离线基准测试和压测
+
+实现 notion_uploader 用到的接口：
+  POST  /v1/file_uploads                 创建上传（single_part / multi_part）
+  POST  /v1/file_uploads/{id}/send       上传分块（multipart/form-data，流式读取后丢弃）
+  POST  /v1/file_uploads/{id}/complete   完成分块上传（检查分块是否齐全）
+  POST  /v1/pages                        创建页面（children 不超过 100）
+  PATCH /v1/pages/{id}                   更新页面属性（封面）
+  PATCH /v1/blocks/{id}/children         追加子块（不超过 100）
+  GET   /_stats                          请求计数、接收字节数、注入的错误数
+
+可注入延迟、共享上行带宽、5xx 错误和 429 限流，模拟真实网络与 API 行为。
+与真实 API 一样，file_upload 只能由创建它的 token 使用，否则返回 404。
+
+用法: python fake_notion.py --port 8765 --latency 0.05 --bandwidth 20 --throttle-rate 0.02
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+MAX_CHILDREN = 100
+
+
+class FakeNotion:
+    def __init__(self, latency=0.0, bandwidth=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1.0, seed=None):
+        self.latency = latency              # 每个请求的固定延迟（秒）
+        self.bandwidth = bandwidth          # 所有连接共享的接收带宽（字节/秒），0 表示不限
+        self.error_rate = error_rate        # 返回 503 的概率
+        self.throttle_rate = throttle_rate  # 返回 429 的概率
+        self.retry_after = retry_after      # 429 响应的 Retry-After（秒）
+        self.rng = random.Random(seed)
+        self.uploads = {}
+        self.pages = {}
+        self.stats = Counter()
+        self._next_free = 0.0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/v1/file_uploads", self.create)
+        app.router.add_post("/v1/file_uploads/{id}/send", self.send)
+        app.router.add_post("/v1/file_uploads/{id}/complete", self.complete)
+        app.router.add_post("/v1/pages", self.create_page)
+        app.router.add_patch("/v1/pages/{id}", self.update_page)
+        app.router.add_patch("/v1/blocks/{id}/children", self.append_children)
+        app.router.add_get("/_stats", self.get_stats)
+        return app
+
+    # ── 故障注入 ─────────────────────────
+    async def _gate(self, name: str):
+        """统一的延迟和错误注入，返回需要直接回复的错误响应或 None"""
+        self.stats[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            self.stats["throttled"] += 1
+            return web.json_response({"object": "error", "status": 429, "code": "rate_limited"},
+                                     status=429, headers={"Retry-After": str(self.retry_after)})
+        if roll < self.throttle_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"object": "error", "status": 503, "code": "service_unavailable"}, status=503)
+        return None
+
+    async def _pace(self, n: int):
+        """按共享带宽限速：所有连接排队占用同一条"上行链路\""""
+        if not self.bandwidth:
+            return
+        now = time.monotonic()
+        self._next_free = max(now, self._next_free) + n / self.bandwidth
+        if self._next_free > now:
+            await asyncio.sleep(self._next_free - now)
+
+    def _upload(self, request, fid: str):
+        """按 id 查找 file_upload；不存在或属于其他 token 时返回 None"""
+        up = self.uploads.get(fid)
+        if up is None or up["token"] != request.headers.get("Authorization"):
+            return None
+        return up
+
+    @staticmethod
+    def _error(status: int, msg: str):
+        return web.json_response({"object": "error", "status": status, "code": "validation_error", "message": msg},
+                                 status=status)
+
+    # ── 接口 ─────────────────────────────
+    async def create(self, request):
+        if (err := await self._gate("create")):
+            return err
+        body = await request.json()
+        fid = str(uuid.uuid4())
+        multi = body.get("mode") == "multi_part"
+        self.uploads[fid] = {
+            "filename": body.get("filename"),
+            "parts": body.get("number_of_parts", 1) if multi else 1,
+            "multi": multi,
+            "received": {},
+            "status": "pending",
+            "token": request.headers.get("Authorization"),
+        }
+        url = f"{request.scheme}://{request.host}/v1/file_uploads/{fid}/send"
+        return web.json_response({"object": "file_upload", "id": fid, "upload_url": url, "status": "pending"})
+
+    async def send(self, request):
+        if (err := await self._gate("send")):
+            return err
+        up = self._upload(request, request.match_info["id"])
+        if up is None:
+            return self._error(404, "file upload not found")
+        reader = await request.multipart()
+        part_number, size = 1, 0
+        while (field := await reader.next()) is not None:
+            if field.name == "part_number":
+                part_number = int(await field.text())
+            elif field.name == "file":
+                while chunk := await field.read_chunk(256 * 1024):
+                    size += len(chunk)
+                    await self._pace(len(chunk))
+        if not 1 <= part_number <= up["parts"]:
+            return self._error(400, f"invalid part_number {part_number}")
+        up["received"][part_number] = size
+        self.stats["bytes"] += size
+        if not up["multi"]:
+            up["status"] = "uploaded"
+        return web.json_response({"object": "file_upload", "id": request.match_info["id"], "status": up["status"]})
+
+    async def complete(self, request):
+        if (err := await self._gate("complete")):
+            return err
+        up = self._upload(request, request.match_info["id"])
+        if up is None:
+            return self._error(404, "file upload not found")
+        missing = set(range(1, up["parts"] + 1)) - set(up["received"])
+        if missing:
+            return self._error(400, f"missing parts {sorted(missing)}")
+        up["status"] = "uploaded"
+        return web.json_response({"object": "file_upload", "id": request.match_info["id"], "status": "uploaded"})
+
+    async def create_page(self, request):
+        if (err := await self._gate("create_page")):
+            return err
+        body = await request.json()
+        children = body.get("children", [])
+        if len(children) > MAX_CHILDREN:
+            return self._error(400, f"body.children.length should be ≤ {MAX_CHILDREN}")
+        for c in children:
+            ref = c.get(c.get("type"), {})
+            if isinstance(ref, dict) and ref.get("type") == "file_upload" and not self._upload(request, ref["file_upload"]["id"]):
+                return self._error(400, "file upload not found for this integration")
+        pid = str(uuid.uuid4())
+        self.pages[pid] = {"properties": body.get("properties", {}), "children": list(children)}
+        return web.json_response({"object": "page", "id": pid, "url": f"https://www.notion.so/{pid.replace('-', '')}"})
+
+    async def update_page(self, request):
+        if (err := await self._gate("update_page")):
+            return err
+        page = self.pages.get(request.match_info["id"])
+        if page is None:
+            return self._error(404, "page not found")
+        page["properties"].update((await request.json()).get("properties", {}))
+        return web.json_response({"object": "page", "id": request.match_info["id"]})
+
+    async def append_children(self, request):
+        if (err := await self._gate("append")):
+            return err
+        page = self.pages.get(request.match_info["id"])
+        if page is None:
+            return self._error(404, "block not found")
+        children = (await request.json()).get("children", [])
+        if len(children) > MAX_CHILDREN:
+            return self._error(400, f"body.children.length should be ≤ {MAX_CHILDREN}")
+        page["children"] += children
+        return web.json_response({"object": "list", "results": children})
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats, pages=len(self.pages)))
+
+
+async def serve(fake: FakeNotion, host: str = "127.0.0.1", port: int = 8765) -> web.AppRunner:
+    """在当前事件循环中启动替身服务，返回 runner（调用方负责 cleanup）"""
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="本地 Notion 文件上传 API 替身")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--latency", type=float, default=0.0, help="每个请求的延迟（秒）")
+    p.add_argument("--bandwidth", type=float, default=0.0, help="共享接收带宽（MB/s），0 表示不限")
+    p.add_argument("--error-rate", type=float, default=0.0, help="返回 503 的概率")
+    p.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 的概率")
+    p.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After（秒）")
+    p.add_argument("--seed", type=int, default=None)
+    return p.parse_args(argv)
+
+
+async def _main(args):
+    fake = FakeNotion(args.latency, args.bandwidth * 1024 * 1024, args.error_rate,
+                      args.throttle_rate, args.retry_after, args.seed)
+    await serve(fake, args.host, args.port)
+    print(f"Fake Notion API 已启动: http://{args.host}:{args.port}/v1", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_main(parse_args()))
+    except KeyboardInterrupt:
+        pass
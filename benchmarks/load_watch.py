@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+端到端压测：模拟 SaveAny Bot 向 WATCH_DIR 写文件，测量监控 → 调度 → 上传整条链路
+
+在临时目录中运行完整的 notion_uploader.main()（watchdog + 稳定检测 + 上传队列），
+上传目标是进程内的 Notion 替身（fake_notion.py）。写入模式：
+  - 相册：{media_group_id} 子目录，内含 {index}{ext} 文件
+  - 慢速分块写入（每块之间暂停，模拟 Telegram 下载速度）
+  - 成批同时出现的相册（burst）
+  - 根目录单文件 {chat_id}_{message_id}{ext}
+
+报告每个任务的 写完→调度、首次发现→调度、调度→页面 延迟，
+并标记遗漏（超时仍未处理）和重复处理（同一任务被执行多次或创建多个页面）的任务。
+
+用法:
+  python benchmarks/load_watch.py --albums 200 --singles 50 --burst 50
+  STABLE_QUIET=2 python benchmarks/load_watch.py --albums 20 --chunk-delay 0.05
+"""
+
+import argparse
+import asyncio
+import contextvars
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent / "notion_uploader_data"))
+sys.path.insert(0, str(HERE))
+os.environ.setdefault("NOTION_TOKEN", "bench-token")
+os.environ.setdefault("NOTION_DATABASE_ID", "bench-db")
+
+from fake_notion import FakeNotion, serve  # noqa: E402
+
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobRecord:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.written = None     # 写入方写完最后一个字节
+        self.detected = None    # 稳定检测第一次看到该任务
+        self.dispatched = []    # 每次提交到上传队列的时间
+        self.runs = 0           # 实际执行的次数
+        self.pages = []         # 创建页面的时间
+        self.done = None        # 上传函数返回
+
+
+# ── 写入方（独立线程，模拟 SaveAny Bot）────
+def write_slowly(path: Path, size: int, chunk: int, delay: float):
+    data = os.urandom(size)
+    with open(path, "wb") as f:
+        for i in range(0, size, chunk):
+            f.write(data[i:i + chunk])
+            f.flush()
+            if delay:
+                time.sleep(delay)
+
+
+def pick_ext(args) -> str:
+    if random.random() < args.video_ratio:
+        return ".mp4"  # 会触发缩略图生成，需要 ffmpeg
+    return random.choice((".jpg", ".jpg", ".png"))
+
+
+def write_album(root: Path, rec: JobRecord, n_files: int, args):
+    d = root / str(random.randrange(10 ** 15, 10 ** 16))  # {media_group_id}
+    d.mkdir()
+    for i in range(1, n_files + 1):
+        if i > 1 and args.file_gap:
+            time.sleep(random.uniform(0, args.file_gap))
+        write_slowly(d / f"{i}{pick_ext(args)}", args.file_kb * 1024, args.chunk_kb * 1024, args.chunk_delay)
+    rec.written = time.monotonic()
+    return d
+
+
+def write_single(root: Path, rec: JobRecord, args):
+    p = root / f"{random.randrange(10 ** 9, 10 ** 10)}_{random.randrange(10 ** 5)}{pick_ext(args)}"
+    write_slowly(p, args.file_kb * 1024, args.chunk_kb * 1024, args.chunk_delay)
+    rec.written = time.monotonic()
+    return p
+
+
+# ── 埋点 ──────────────────────────────
+class RecordingDict(dict):
+    """替换 nu.stability，记录每个任务第一次被稳定检测看到的时间"""
+    def __init__(self, on_first):
+        super().__init__()
+        self.on_first = on_first
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.on_first(key)
+        return super().setdefault(key, default)
+
+
+def instrument(nu, records: dict):
+    def first_seen(key):
+        records.setdefault(key, JobRecord("?")).detected = time.monotonic()
+    nu.stability = RecordingDict(first_seen)
+
+    orig_submit = nu.scheduler.submit
+    def submit(fn, path, size):
+        records.setdefault(str(path), JobRecord("?")).dispatched.append(time.monotonic())
+        async def run(p):
+            rec = records[str(p)]
+            rec.runs += 1
+            token = current_job.set(rec)
+            try:
+                await fn(p)
+            finally:
+                current_job.reset(token)
+                rec.done = time.monotonic()
+        run.__name__ = fn.__name__
+        orig_submit(run, path, size)
+    nu.scheduler.submit = submit
+
+    orig_page = nu._create_page
+    async def create_page(*a, **kw):
+        page = await orig_page(*a, **kw)
+        rec = current_job.get()
+        if rec is not None:
+            rec.pages.append(time.monotonic())
+        return page
+    nu._create_page = create_page
+
+
+def stats(values: list) -> str:
+    if not values:
+        return "-"
+    s = sorted(values)
+    pick = lambda q: s[min(len(s) - 1, max(0, -(-q * len(s) // 100) - 1))]
+    return f"p50 {pick(50):7.2f}s  p95 {pick(95):7.2f}s  p99 {pick(99):7.2f}s  max {s[-1]:7.2f}s"
+
+
+async def main(args):
+    root = Path(tempfile.mkdtemp(prefix="notion_load_"))
+    os.environ["WATCH_DIR"] = str(root)
+    import notion_uploader as nu
+    import logging
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    fake = FakeNotion(latency=args.latency, throttle_rate=args.throttle_rate, retry_after=0.2)
+    runner = await serve(fake, port=args.port)
+    nu.NOTION_API = f"http://127.0.0.1:{args.port}/v1"
+    for acc in nu.accounts:
+        acc.limiter = nu.RateLimiter(args.rps, max(1, int(args.rps * 2)))
+
+    records = {}
+    instrument(nu, records)
+    uploader = asyncio.create_task(nu.main())
+    await asyncio.sleep(0.5)
+
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(args.writers)
+    lock = threading.Lock()
+
+    def album_job():
+        rec = JobRecord("album")
+        d = write_album(root, rec, random.randint(1, args.max_files), args)
+        with lock:
+            records.setdefault(str(d), rec).__dict__.update(kind="album", written=rec.written)
+
+    def single_job():
+        rec = JobRecord("single")
+        p = write_single(root, rec, args)
+        with lock:
+            records.setdefault(str(p), rec).__dict__.update(kind="single", written=rec.written)
+
+    t0 = time.monotonic()
+    futures = []
+    jobs = ["album"] * args.albums + ["single"] * args.singles
+    random.shuffle(jobs)
+    for i in range(0, len(jobs), args.burst):
+        for kind in jobs[i:i + args.burst]:
+            futures.append(loop.run_in_executor(pool, album_job if kind == "album" else single_job))
+        if args.burst_interval and i + args.burst < len(jobs):
+            await asyncio.sleep(args.burst_interval)
+    await asyncio.gather(*futures)
+    written_at = time.monotonic()
+    print(f"写入完成：{args.albums} 个相册、{args.singles} 个单文件，用时 {written_at - t0:.1f} 秒", flush=True)
+
+    # 等待全部任务处理完毕或超时
+    expected = {k for k, r in records.items() if r.kind != "?"}
+    while time.monotonic() - written_at < args.timeout:
+        if all(records[k].done for k in expected) and not nu.scheduler.running and not nu.scheduler.depth:
+            break
+        await asyncio.sleep(0.2)
+    await asyncio.sleep(args.settle)  # 留出时间暴露迟到的重复处理
+
+    uploader.cancel()
+    try:
+        await uploader
+    except asyncio.CancelledError:
+        pass
+    pool.shutdown()
+    await runner.cleanup()
+
+    # ── 报告 ─────────────────────────────
+    done = [records[k] for k in expected if records[k].pages]
+    missed = [k for k in expected if not records[k].pages]
+    dup = [k for k in expected if records[k].runs > 1 or len(records[k].pages) > 1]
+    unknown = [k for k, r in records.items() if r.kind == "?" and r.dispatched]
+    print(f"\n任务 {len(expected)}，完成 {len(done)}，遗漏 {len(missed)}，重复处理 {len(dup)}，"
+          f"非预期任务 {len(unknown)}，总耗时 {time.monotonic() - t0:.1f} 秒")
+    print(f"429 次数: {fake.stats['throttled']}，Notion 请求: "
+          f"{sum(fake.stats[k] for k in ('create', 'send', 'complete', 'create_page', 'update_page', 'append'))}")
+    for kind in ("album", "single"):
+        rs = [r for r in done if r.kind == kind and r.dispatched]
+        if not rs:
+            continue
+        print(f"\n[{kind}] {len(rs)} 个")
+        print("  写完→调度   ", stats([r.dispatched[0] - r.written for r in rs]))
+        print("  首次发现→调度", stats([r.dispatched[0] - r.detected for r in rs if r.detected]))
+        print("  调度→页面   ", stats([r.pages[0] - r.dispatched[0] for r in rs]))
+        print("  写完→页面   ", stats([r.pages[0] - r.written for r in rs]))
+    for title, keys in (("遗漏", missed), ("重复处理", dup), ("非预期任务", unknown)):
+        for k in keys[:10]:
+            r = records[k]
+            seen = "未发现" if r.detected is None else f"写完后 {r.detected - r.written:+.2f}s 发现"
+            print(f"  {title}: {Path(k).name} ({seen}，调度 {len(r.dispatched)} 次，执行 {r.runs} 次，页面 {len(r.pages)} 个)")
+    shutil.rmtree(root, ignore_errors=True)
+    return 1 if missed or dup or unknown else 0
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="模拟 SaveAny Bot 写入的端到端压测")
+    p.add_argument("--albums", type=int, default=50, help="相册数量")
+    p.add_argument("--max-files", type=int, default=10, help="每个相册最多文件数（随机 1~N）")
+    p.add_argument("--singles", type=int, default=20, help="根目录单文件数量")
+    p.add_argument("--file-kb", type=int, default=256, help="每个文件大小（KB）")
+    p.add_argument("--chunk-kb", type=int, default=64, help="写入块大小（KB）")
+    p.add_argument("--chunk-delay", type=float, default=0.01, help="写入块之间的间隔（秒）")
+    p.add_argument("--file-gap", type=float, default=0.5, help="相册内文件之间的最大随机间隔（秒）")
+    p.add_argument("--video-ratio", type=float, default=0.0, help="视频文件比例（需要 ffmpeg）")
+    p.add_argument("--burst", type=int, default=50, help="每批同时开始写入的任务数")
+    p.add_argument("--burst-interval", type=float, default=2.0, help="批次之间的间隔（秒）")
+    p.add_argument("--writers", type=int, default=32, help="并行写入线程数")
+    p.add_argument("--rps", type=float, default=1000, help="上传器限速（次/秒），默认不限制以隔离监控链路")
+    p.add_argument("--latency", type=float, default=0.02, help="Notion 替身每个请求的延迟（秒）")
+    p.add_argument("--throttle-rate", type=float, default=0.0, help="Notion 替身返回 429 的概率")
+    p.add_argument("--port", type=int, default=8766)
+    p.add_argument("--timeout", type=float, default=180, help="写入结束后最多等待处理的秒数")
+    p.add_argument("--settle", type=float, default=3, help="全部完成后额外观察重复处理的秒数")
+    p.add_argument("-v", "--verbose", action="store_true", help="显示上传器日志")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -1,85 +1,783 @@
-import os, mimetypes, math, shutil, asyncio, logging, aiohttp, time, subprocess, tempfile
+import os, re, socket, sqlite3, hashlib, mimetypes, math, shutil, asyncio, logging, aiohttp, time, tempfile, random, itertools
 from pathlib import Path
-from io import BytesIO
 from dotenv import load_dotenv
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from notion_client import AsyncClient
-from threading import Timer
+import queue, heapq, contextvars, threading, multiprocessing, bisect
+from collections import defaultdict
+from contextlib import contextmanager
+from aiohttp import web
+from concurrent.futures import ProcessPoolExecutor
+
+try:  # 可选依赖：仅 OPTIMIZE_IMAGES 需要
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:  # 可选：让 Pillow 能读取 HEIC/HEIF
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
 
 # ── ENV ───────────────────────────────
 load_dotenv()
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 NOTION_DB    = os.getenv("NOTION_DATABASE_ID")
+# 可选：多个集成 token（逗号分隔）分摊请求配额；数据库可以只填一个（所有 token 共用），或与 token 一一对应
+NOTION_TOKENS = [t.strip() for t in os.getenv("NOTION_TOKENS", "").split(",") if t.strip()] or [NOTION_TOKEN]
+NOTION_DBS   = [d.strip() for d in os.getenv("NOTION_DATABASE_IDS", "").split(",") if d.strip()] or [NOTION_DB]
 WATCH_DIR    = Path(os.getenv("WATCH_DIR", "/downloads"))
-STABLE_DELAY = 60.0  # 文件夹稳定检测延时（秒）
+STABLE_DELAY = float(os.getenv("STABLE_DELAY", "60"))  # 稳定检测的最长静默期（秒）
+STABLE_QUIET = float(os.getenv("STABLE_QUIET", "5"))  # 初始静默期：最后一次写入后至少等待的秒数
+STABLE_POLL  = 1.0  # 两次大小/mtime 快照的间隔（秒）
+STABLE_MARKER = os.getenv("STABLE_MARKER", "")  # 可选完成标记文件名，出现在相册目录中即立即处理
+WATCH_MODE   = os.getenv("WATCH_MODE", "inotify").lower()  # inotify=系统文件事件，poll=轮询（NFS/SMB 等事件不可靠的挂载）
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "2"))  # 轮询模式的扫描间隔（秒）
+POLL_FULL_RESCAN = 60.0  # 轮询模式下完整重新扫描的间隔（秒），兜底目录 mtime 缓存不准的文件系统
 PART_SIZE    = 19 * 1024 * 1024  # 使用原来工作的大小
 SINGLE_LIMIT = 20 * 1024 * 1024  # 使用原来工作的大小
+MAX_FILE_SIZE = int(float(os.getenv("MAX_FILE_MB", "5120")) * 1024 * 1024)  # Notion 单文件上限，超过的视频切段上传，0 表示不检查
 NOTION_VER   = "2022-06-28"
+NOTION_API   = "https://api.notion.com/v1"
+HTTP_POOL    = int(os.getenv("HTTP_POOL_SIZE", "16"))  # 连接池最大连接数
+PART_CONCURRENCY = int(os.getenv("PART_CONCURRENCY", "4"))  # 单个大文件同时上传的分块数
+READ_CHUNK   = 256 * 1024  # 流式读取磁盘的缓冲大小
+MB = 1024 * 1024
+UPLOAD_BANDWIDTH = float(os.getenv("UPLOAD_BANDWIDTH_MB", "0")) * MB  # 全局上传带宽上限（字节/秒），0 表示不限
+BANDWIDTH_SCHEDULE = os.getenv("BANDWIDTH_SCHEDULE", "")  # 分时段带宽：HH:MM-HH:MM=MB/s，逗号分隔，未覆盖的时段用 UPLOAD_BANDWIDTH_MB
+YIELD_DOWNLOAD = float(os.getenv("YIELD_DOWNLOAD_MB", "0")) * MB  # WATCH_DIR 下载速度超过该值时上传让路，0 表示关闭
+YIELD_BANDWIDTH = float(os.getenv("YIELD_BANDWIDTH_MB", "1")) * MB  # 让路期间的上传带宽上限
+YIELD_SAMPLE = 2.0  # 统计下载速度的间隔（秒）
+NOTION_RPS   = float(os.getenv("NOTION_RPS", "3"))  # Notion API 平均请求速率上限（次/秒）
+NOTION_BURST = int(os.getenv("NOTION_BURST", "10"))  # 允许的瞬时突发请求数
+API_RETRIES  = int(os.getenv("API_RETRIES", "5"))  # 单个请求遇到 429/5xx/网络错误时的重试次数
+JOURNAL_PATH = Path(os.getenv("JOURNAL_PATH", str(WATCH_DIR / ".uploader_journal.db")))  # 断点续传日志
+JOURNAL_TTL  = 55 * 60  # Notion 未使用的 file_upload 约 1 小时后过期，超过该时间的记录不再续传
+DEDUP_MODE   = os.getenv("DEDUP_MODE", "off").lower()  # 重复内容处理：off=关闭（默认），link=新页面链接到已有页面，skip=直接跳过
+DEDUP_MAX    = int(os.getenv("DEDUP_MAX_ENTRIES", "20000"))  # 去重索引最多保留的条目数
+DEDUP_TTL    = float(os.getenv("DEDUP_TTL_DAYS", "30")) * 86400  # 超过该天数未命中的索引条目被淘汰
+FILE_RETRIES = int(os.getenv("FILE_RETRIES", "2"))  # 相册内单个文件失败后的重试次数
+THUMB_CONCURRENCY = int(os.getenv("THUMB_CONCURRENCY", "2"))  # 同时运行的 ffmpeg 进程数
+THUMB_TIMEOUT = float(os.getenv("THUMB_TIMEOUT", "30"))  # 单个缩略图生成超时（秒）
+THUMB_MAX_WIDTH = int(os.getenv("THUMB_MAX_WIDTH", "1280"))  # 缩略图最大宽度
+DEFER_COVER  = os.getenv("DEFER_COVER", "false").lower() in ("1", "true", "yes")  # 先建页面，缩略图就绪后再补封面
+OPTIMIZE_IMAGES = os.getenv("OPTIMIZE_IMAGES", "false").lower() in ("1", "true", "yes")  # 上传前压缩/缩放图片（需要 Pillow）
+OPTIMIZE_MAX_DIM = int(os.getenv("OPTIMIZE_MAX_DIM", "2560"))  # 图片长边超过该像素时等比缩小
+OPTIMIZE_QUALITY = int(os.getenv("OPTIMIZE_QUALITY", "85"))  # JPEG/WebP 输出质量
+OPTIMIZE_RULES = dict(r.strip().split("=", 1) for r in os.getenv(  # MIME → 输出格式（jpeg/png/webp），未列出的类型原样上传
+    "OPTIMIZE_RULES", "image/jpeg=jpeg,image/png=png,image/bmp=png,image/tiff=jpeg,image/heic=jpeg,image/heif=jpeg").split(",") if "=" in r)
+OPTIMIZE_WORKERS = int(os.getenv("OPTIMIZE_WORKERS", "2"))  # 图片优化进程数
+ALBUM_CONCURRENCY = int(os.getenv("ALBUM_CONCURRENCY", "4"))  # 同一相册内同时上传的文件数
+PAGE_BATCH   = 100  # Notion 单次请求最多 100 个子块
+APPEND_INTERVAL = float(os.getenv("PAGE_APPEND_INTERVAL", "2"))  # 相册页面追加块的最小间隔（秒），合并为批量请求
+COALESCE_MODE = os.getenv("COALESCE_MODE", "off").lower()  # 根目录单文件合并：off=关闭，window=按时间窗口，chat=按时间窗口且同一 chat_id
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "10"))  # 合并窗口（秒），从组内第一个文件写完开始计时
+COALESCE_MAX = int(os.getenv("COALESCE_MAX", "50"))  # 每个合并页面最多的文件数
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "3"))  # 同时处理的上传任务数（文件/相册）
+AGING_RATE   = float(os.getenv("AGING_MB_PER_SEC", "10")) * 1024 * 1024  # 排队每等待 1 秒，相当于任务变小的字节数
+MULTI_INSTANCE = os.getenv("MULTI_INSTANCE", "false").lower() in ("1", "true", "yes")  # 多个实例共享同一 WATCH_DIR
+INSTANCE_ID  = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"  # 租约中记录的实例名
+LEASE_TTL    = float(os.getenv("LEASE_TTL", "60"))  # 租约超过该秒数未续期视为持有实例已失效
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Prometheus 指标端口，0 表示关闭
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 log = logging.getLogger("uploader")
 
-notion = AsyncClient(auth=NOTION_TOKEN)
-
 # 目录处理队列和锁机制
-pending_dirs = {}
+pending_dirs = {}  # 路径 → 下一次稳定检查的时间（loop.time()）
+stability = {}  # 路径 → JobState
+close_events_seen = False  # 平台是否上报 close-write 事件（Linux inotify 会）
 processing_dirs = set()  # 记录正在处理的目录
 
+# ── 指标 ──────────────────────────────
+class Metrics:
+    """极简 Prometheus 指标：计数器、仪表和直方图，只在事件循环线程中更新"""
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+    def __init__(self):
+        self.kinds = {}   # 名称 → (类型, 说明)
+        self.values = defaultdict(float)  # (名称, 标签) → 值
+        self.hists = {}   # (名称, 标签) → [各桶计数, 总和, 次数]
+        self.probes = {}  # 名称 → 采集时调用的函数
+
+    def define(self, name: str, kind: str, help: str, probe=None):
+        self.kinds[name] = (kind, help)
+        if probe: self.probes[name] = probe
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        h = self.hists.setdefault((name, tuple(sorted(labels.items()))), [[0] * len(self.BUCKETS), 0.0, 0])
+        for i, b in enumerate(self.BUCKETS):
+            if value <= b: h[0][i] += 1
+        h[1] += value; h[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.monotonic()
+        try: yield
+        finally: self.observe(name, time.monotonic() - t0, **labels)
+
+    def render(self) -> str:
+        fmt = lambda labels, extra=(): "{%s}" % ",".join(f'{k}="{v}"' for k, v in (*labels, *extra)) if (labels or extra) else ""
+        out = []
+        for name, (kind, help) in self.kinds.items():
+            out += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            if name in self.probes:
+                out.append(f"{name} {self.probes[name]()}")
+            for (n, labels), v in self.values.items():
+                if n == name: out.append(f"{name}{fmt(labels)} {v}")
+            for (n, labels), (buckets, total, count) in self.hists.items():
+                if n != name: continue
+                for b, c in zip(self.BUCKETS, buckets):
+                    out.append(f"{name}_bucket{fmt(labels, (('le', '+Inf' if b == float('inf') else b),))} {c}")
+                out += [f"{name}_sum{fmt(labels)} {total}", f"{name}_count{fmt(labels)} {count}"]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.define("uploader_bytes_uploaded_total", "counter", "已成功上传到 Notion 的字节数")
+metrics.define("uploader_inflight_bytes", "gauge", "正在发送中的分块字节数")
+metrics.define("uploader_stage_seconds", "histogram", "各阶段耗时（create/send/complete/create_page/append/thumbnail/optimize）")
+metrics.define("uploader_stability_wait_seconds", "histogram", "任务从首次发现到判定稳定的等待时间")
+metrics.define("uploader_api_retries_total", "counter", "Notion 请求重试次数（按原因）")
+metrics.define("uploader_throttled_total", "counter", "Notion 返回 429 的次数（按集成 token）")
+metrics.define("uploader_optimized_bytes_saved_total", "counter", "图片优化节省的上传字节数")
+metrics.define("uploader_pages_created_total", "counter", "创建的 Notion 页面数")
+metrics.define("uploader_pending_jobs", "gauge", "等待稳定检测的任务数", lambda: len(pending_dirs))
+metrics.define("uploader_processing_jobs", "gauge", "已判定稳定、排队或上传中的任务数", lambda: len(processing_dirs))
+metrics.define("uploader_queue_depth", "gauge", "上传队列中等待 worker 的任务数", lambda: scheduler.depth)
+metrics.define("uploader_running_jobs", "gauge", "worker 正在执行的任务数", lambda: scheduler.running)
+metrics.define("uploader_bandwidth_limit_bytes", "gauge", "当前上传带宽上限（字节/秒），0 表示不限", lambda: bandwidth.rate())
+
+async def start_metrics_server():
+    """启动 /metrics HTTP 端点（METRICS_PORT 为 0 时不启动），返回 runner 供退出时清理"""
+    if not METRICS_PORT:
+        return None
+    async def handle(_):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", METRICS_PORT).start()
+    log.info("指标端点: http://0.0.0.0:%d/metrics", METRICS_PORT)
+    return runner
+
+# ── HTTP 连接池 ───────────────────────
+# 全进程共享一个长连接会话，避免每个文件重复 TLS 握手和 DNS 解析
+http: aiohttp.ClientSession = None
+
+async def open_http():
+    """创建共享会话（在 main() 中调用一次）"""
+    global http
+    if http is None or http.closed:
+        conn = aiohttp.TCPConnector(limit=HTTP_POOL, limit_per_host=HTTP_POOL,
+                                    ttl_dns_cache=300, keepalive_timeout=60, enable_cleanup_closed=True)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+        http = aiohttp.ClientSession(connector=conn, timeout=timeout)
+    return http
+
+async def close_http():
+    global http
+    if http is not None and not http.closed:
+        await http.close()
+    http = None
+
+# ── 限速与重试 ────────────────────────
+class RateLimiter:
+    """令牌桶（每个集成 token 一个）：请求先取令牌；遇到 429 时按 Retry-After 暂停并减半速率，成功后逐步恢复"""
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttled(self, delay: float):
+        now = time.monotonic()
+        if now >= self.paused_until:
+            # 并发请求在同一次限流中会同时收到多个 429，每个暂停窗口只减速一次
+            self.rate = max(self.max_rate * 0.1, self.rate / 2)
+        self.paused_until = max(self.paused_until, now + delay)
+        self.tokens = 0.0
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+def _parse_schedule(spec: str) -> list:
+    """解析 BANDWIDTH_SCHEDULE，返回 [(开始分钟, 结束分钟, 字节/秒)]；结束早于开始表示跨午夜"""
+    out = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        try:
+            span, rate = item.split("=")
+            start, end = ((lambda h, m: int(h) * 60 + int(m))(*t.split(":")) for t in span.split("-"))
+            out.append((start, end, float(rate) * MB))
+        except ValueError:
+            raise SystemExit(f"BANDWIDTH_SCHEDULE 格式错误: {item}（应为 HH:MM-HH:MM=MB/s）")
+    return out
+
+class Bandwidth:
+    """全局上传带宽令牌桶（字节/秒），所有任务和分块共享，在 FileSlice 写出每个读取块前取令牌。
+    速率按当前时段取 BANDWIDTH_SCHEDULE，否则为 UPLOAD_BANDWIDTH；下载活跃（yielding）时不超过 YIELD_BANDWIDTH"""
+    def __init__(self, default: float, schedule: list):
+        self.default, self.schedule = default, schedule
+        self.yielding = False
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def rate(self) -> float:
+        """当前带宽上限，0 表示不限"""
+        rate = self.default
+        if self.schedule:
+            t = time.localtime(); m = t.tm_hour * 60 + t.tm_min
+            for start, end, r in self.schedule:
+                if (start <= m < end) if start <= end else (m >= start or m < end):
+                    rate = r; break
+        if self.yielding:
+            rate = min(rate, YIELD_BANDWIDTH) if rate else YIELD_BANDWIDTH
+        return rate
+
+    async def take(self, n: int):
+        if not (self.default or self.schedule or self.yielding):
+            return
+        async with self._lock:
+            rate = self.rate()
+            now = time.monotonic()
+            if not rate:
+                self.tokens, self.stamp = 0.0, now
+                return
+            # 最多积攒 1 秒的额度；不足时记为欠账并等待还清，排队的请求按顺序依次放行
+            self.tokens = min(rate, self.tokens + (now - self.stamp) * rate) - n
+            self.stamp = now
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / rate)
+
+bandwidth = Bandwidth(UPLOAD_BANDWIDTH, _parse_schedule(BANDWIDTH_SCHEDULE))
+
+async def watch_downloads():
+    """YIELD_DOWNLOAD_MB：按尚未稳定（正在下载）的任务的增长量估算 WATCH_DIR 的下载速度，
+    超过阈值时上传让路，降到阈值一半以下时恢复"""
+    prev = {}
+    while True:
+        await asyncio.sleep(YIELD_SAMPLE)
+        keys = [k for k in stability if k not in processing_dirs]
+        sizes = await asyncio.to_thread(lambda: {k: _job_size(Path(k)) for k in keys})
+        speed = sum(max(0, n - prev[k]) for k, n in sizes.items() if k in prev) / YIELD_SAMPLE
+        prev = sizes
+        if not bandwidth.yielding and speed >= YIELD_DOWNLOAD:
+            log.info("下载速度 %.1f MB/s，上传让路（限速 %.1f MB/s）", speed / MB, YIELD_BANDWIDTH / MB)
+            bandwidth.yielding = True
+        elif bandwidth.yielding and speed < YIELD_DOWNLOAD / 2:
+            log.info("下载速度降至 %.1f MB/s，恢复上传带宽", speed / MB)
+            bandwidth.yielding = False
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class Account:
+    """一个 Notion 集成：token、目标数据库和独立的限速器。
+    任务开始时分配一个账号并在整个任务（含重试）中沿用，file_upload id 只在创建它的 token 下使用"""
+    def __init__(self, name: str, token: str, db: str):
+        self.name, self.db = name, db
+        self.h_auth = {"Authorization": f"Bearer {token}", "Notion-Version": NOTION_VER}
+        self.h_json = self.h_auth | {"Content-Type": "application/json", "accept": "application/json"}
+        self.limiter = RateLimiter(NOTION_RPS, NOTION_BURST)
+        self.active = 0  # 正在使用该账号的任务数
+
+if len(NOTION_DBS) not in (1, len(NOTION_TOKENS)):
+    raise SystemExit(f"NOTION_DATABASE_IDS 需要填 1 个或与 NOTION_TOKENS 数量相同（{len(NOTION_TOKENS)} 个）")
+accounts = [Account(str(i + 1), t, NOTION_DBS[i % len(NOTION_DBS)]) for i, t in enumerate(NOTION_TOKENS)]
+current_account = contextvars.ContextVar("current_account", default=None)
+
+def _account() -> Account:
+    """当前任务的账号；任务之外（如基准测试直接调用）使用第一个"""
+    return current_account.get() or accounts[0]
+
+def pick_account() -> Account:
+    """为新任务选择账号：避开正在 429 暂停的 token，其余按 任务数/当前速率 取最空闲的"""
+    now = time.monotonic()
+    return min(accounts, key=lambda a: (a.limiter.paused_until > now, a.active / a.limiter.rate))
+
+def job_account(path: Path) -> Account:
+    """任务的账号：沿用日志中记录的（进程重启或其他实例接管时，已有的 file_upload 和页面只能由同一个 token 继续），
+    没有记录或该 token 已不在配置中时新选一个并记入日志"""
+    name = journal.job_account(path)
+    acc = next((a for a in accounts if a.name == name), None) or pick_account()
+    journal.set_job_account(path, acc.name)
+    return acc
+
+@contextmanager
+def use_account(acc: Account):
+    acc.active += 1
+    token = current_account.set(acc)
+    try: yield acc
+    finally:
+        current_account.reset(token)
+        acc.active -= 1
+
+def _backoff(attempt: int) -> float:
+    """带抖动的指数退避：0.5~1 倍的 1,2,4,8... 秒，上限 60 秒"""
+    return min(60.0, 2.0 ** attempt) * random.uniform(0.5, 1.0)
+
+def _retry_after(r) -> float:
+    try: return max(0.0, float(r.headers.get("Retry-After", "")))
+    except ValueError: return None
+
+async def _api(method, url, **kw):
+    """所有 Notion 请求的统一出口：限速、429/5xx/网络错误自动重试。
+    data 可以传入无参函数，每次重试时重新构造请求体"""
+    acc = _account()
+    limiter = acc.limiter
+    kw.setdefault("headers", acc.h_json)
+    data = kw.pop("data", None)
+    for attempt in range(API_RETRIES + 1):
+        await limiter.acquire()
+        if data is not None:
+            kw["data"] = data() if callable(data) else data
+        try:
+            async with http.request(method, url, **kw) as r:
+                if r.status not in RETRY_STATUS or attempt == API_RETRIES:
+                    r.raise_for_status()
+                    limiter.succeeded()
+                    return await r.json(content_type=None)
+                delay = _retry_after(r)
+                if delay is None: delay = _backoff(attempt)
+                if r.status == 429:
+                    limiter.throttled(delay)
+                    metrics.inc("uploader_throttled_total", account=acc.name)
+                metrics.inc("uploader_api_retries_total", reason=str(r.status))
+                log.warning("Notion 返回 %s，%.1f 秒后重试（第 %d 次）: %s", r.status, delay, attempt + 1, url)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == API_RETRIES: raise
+            delay = _backoff(attempt)
+            metrics.inc("uploader_api_retries_total", reason="network")
+            log.warning("请求 Notion 出错，%.1f 秒后重试（第 %d 次）: %s", delay, attempt + 1, e)
+        await asyncio.sleep(delay)
+
 # ── Notion Helper ─────────────────────
-async def _create(sess,name,mime,multi,parts=1):
+async def _create(name,mime,multi,parts=1):
     p={"filename":name,"content_type":mime}
     if multi: p|={"mode":"multi_part","number_of_parts":parts}
-    h={"Authorization":f"Bearer {NOTION_TOKEN}","Notion-Version":NOTION_VER,"Content-Type":"application/json"}
-    async with sess.post("https://api.notion.com/v1/file_uploads",json=p,headers=h) as r: r.raise_for_status(); return await r.json()
+    with metrics.timer("uploader_stage_seconds", stage="create"):
+        return await _api("POST",f"{NOTION_API}/file_uploads",json=p)
+
+def _read_at(f, pos: int, n: int) -> bytes:
+    f.seek(pos); return f.read(n)
+
+class FileSlice(aiohttp.payload.Payload):
+    """文件 [offset, offset+length) 区间的流式请求体，磁盘读取放在线程池中执行，不阻塞事件循环"""
+    def __init__(self, fp: Path, offset: int, length: int, **kw):
+        super().__init__(fp, **kw)
+        self._offset, self._size = offset, length
+
+    def decode(self, encoding="utf-8", errors="strict"):
+        raise TypeError("FileSlice 不支持 decode")
+
+    async def write(self, writer):
+        await self.write_with_length(writer, None)
+
+    async def write_with_length(self, writer, content_length):
+        loop = asyncio.get_running_loop()
+        left = self._size if content_length is None else min(self._size, content_length)
+        pos = self._offset
+        f = await loop.run_in_executor(None, open, self._value, "rb")
+        try:
+            while left > 0:
+                chunk = await loop.run_in_executor(None, _read_at, f, pos, min(READ_CHUNK, left))
+                if not chunk: break
+                await bandwidth.take(len(chunk))
+                await writer.write(chunk)
+                pos += len(chunk); left -= len(chunk)
+        finally:
+            f.close()
+
+async def _send(url,idx,fp,offset,length,mime):
+    def form():
+        f=aiohttp.FormData();f.add_field("part_number",str(idx))
+        f.add_field("file",FileSlice(fp,offset,length,content_type=mime),filename=f"part{idx}")
+        return f
+    metrics.inc("uploader_inflight_bytes", length)
+    try:
+        with metrics.timer("uploader_stage_seconds", stage="send"):
+            await _api("POST",url,data=form,headers=_account().h_auth)
+        metrics.inc("uploader_bytes_uploaded_total", length)
+    finally:
+        metrics.inc("uploader_inflight_bytes", -length)
+
+async def _complete(fid):
+    with metrics.timer("uploader_stage_seconds", stage="complete"):
+        await _api("POST",f"{NOTION_API}/file_uploads/{fid}/complete")
+
+# ── 断点续传日志 ─────────────────────
+class Journal:
+    """SQLite 上传日志：记录任务、file_upload id 和已确认的分块，进程重启后从断点续传。
+    只在事件循环线程中使用；未 open() 时所有方法为空操作"""
+    def __init__(self, path: Path):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs  (path TEXT PRIMARY KEY, created REAL NOT NULL, account TEXT);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, fid TEXT,
+                                              url TEXT, parts INTEGER, completed INTEGER DEFAULT 0, created REAL,
+                                              account TEXT);
+            CREATE TABLE IF NOT EXISTS parts (fid TEXT, n INTEGER, PRIMARY KEY (fid, n));
+            CREATE TABLE IF NOT EXISTS media_index (digest TEXT PRIMARY KEY, page_id TEXT, url TEXT, used REAL);
+            CREATE TABLE IF NOT EXISTS pages (path TEXT PRIMARY KEY, page_id TEXT, url TEXT, next INTEGER, cover INTEGER,
+                                              account TEXT);
+        """)
+        for table in ("jobs", "files", "pages"):
+            if "account" not in {r[1] for r in self.db.execute(f"PRAGMA table_info({table})")}:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN account TEXT")  # 旧版本日志
+        expired = time.time() - JOURNAL_TTL
+        self.db.execute("DELETE FROM parts WHERE fid IN (SELECT fid FROM files WHERE created < ?)", (expired,))
+        self.db.execute("DELETE FROM files WHERE created < ?", (expired,))
+
+    def close(self):
+        if self.db: self.db.close(); self.db = None
+
+    def _x(self, sql, *args):
+        return self.db.execute(sql, args) if self.db else None
+
+    # 任务（文件或相册目录）
+    def job_start(self, path: Path):
+        self._x("INSERT OR IGNORE INTO jobs (path, created) VALUES (?, ?)", str(path), time.time())
+
+    def job_done(self, path: Path):
+        self._x("DELETE FROM jobs WHERE path = ?", str(path))
+
+    def job_account(self, path: Path) -> str:
+        """任务上次使用的账号：已建页面记录的优先，其次是任务记录的"""
+        r = self._x("SELECT account FROM pages WHERE path = ? AND account IS NOT NULL UNION ALL "
+                    "SELECT account FROM jobs WHERE path = ? AND account IS NOT NULL", str(path), str(path)).fetchone() if self.db else None
+        return r[0] if r else None
+
+    def set_job_account(self, path: Path, account: str):
+        self._x("UPDATE jobs SET account = ? WHERE path = ?", account, str(path))
+
+    def jobs(self) -> list:
+        return [Path(r[0]) for r in self._x("SELECT path FROM jobs ORDER BY created")] if self.db else []
+
+    # 单个文件的 file_upload 和分块进度
+    def lookup(self, fp: Path, st) -> dict:
+        if not self.db: return None
+        # file_upload 只能由创建它的 token 继续使用
+        r = self._x("SELECT fid, url, parts, completed FROM files WHERE path = ? AND size = ? AND mtime = ? AND created >= ? "
+                    "AND account IS ?", str(fp), st.st_size, st.st_mtime, time.time() - JOURNAL_TTL, _account().name).fetchone()
+        if not r: return None
+        done = {n for (n,) in self._x("SELECT n FROM parts WHERE fid = ?", r[0])}
+        return {"id": r[0], "upload_url": r[1], "parts": r[2], "completed": bool(r[3]), "done": done}
+
+    def begin(self, fp: Path, st, up: dict, parts: int):
+        self.forget(fp)
+        self._x("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                str(fp), st.st_size, st.st_mtime, up["id"], up["upload_url"], parts, time.time(), _account().name)
 
-async def _send(sess,url,idx,chunk,mime):
-    f=aiohttp.FormData();f.add_field("part_number",str(idx));f.add_field("file",BytesIO(chunk),filename=f"part{idx}",content_type=mime)
-    h={"Authorization":f"Bearer {NOTION_TOKEN}","Notion-Version":NOTION_VER}
-    async with sess.post(url,data=f,headers=h) as r: r.raise_for_status()
+    def part_done(self, fid: str, n: int):
+        self._x("INSERT OR IGNORE INTO parts VALUES (?, ?)", fid, n)
 
-async def _complete(sess,fid):
-    h={"Authorization":f"Bearer {NOTION_TOKEN}","Notion-Version":NOTION_VER,"accept":"application/json"}
-    async with sess.post(f"https://api.notion.com/v1/file_uploads/{fid}/complete",headers=h) as r: r.raise_for_status()
+    def completed(self, fid: str):
+        self._x("UPDATE files SET completed = 1 WHERE fid = ?", fid)
+
+    def forget(self, fp: Path):
+        self._x("DELETE FROM parts WHERE fid IN (SELECT fid FROM files WHERE path = ?)", str(fp))
+        self._x("DELETE FROM files WHERE path = ?", str(fp))
+
+    # 任务已创建的页面和已写入的文件数：进程退出或其他实例接管后在同一页面上继续，不重复建页
+    def page_state(self, path: Path) -> dict:
+        r = self._x("SELECT page_id, url, next, cover FROM pages WHERE path = ?", str(path)).fetchone() if self.db else None
+        return {"id": r[0], "url": r[1], "next": r[2], "cover": bool(r[3])} if r else None
+
+    def page_progress(self, path: Path, page: dict, next: int, cover: bool):
+        self._x("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                str(path), page["id"], page["url"], next, int(cover), _account().name)
+
+    def page_done(self, path: Path):
+        self._x("DELETE FROM pages WHERE path = ?", str(path))
+
+    # 内容指纹 → 已创建页面，用于跳过重复转发的媒体
+    def seen(self, digest: str) -> dict:
+        if not (self.db and digest): return None
+        r = self._x("SELECT page_id, url FROM media_index WHERE digest = ? AND used >= ?",
+                    digest, time.time() - DEDUP_TTL).fetchone()
+        if not r: return None
+        self._x("UPDATE media_index SET used = ? WHERE digest = ?", time.time(), digest)
+        return {"id": r[0], "url": r[1]}
+
+    def remember(self, digest: str, page: dict):
+        if not (self.db and digest): return
+        self._x("INSERT OR REPLACE INTO media_index VALUES (?, ?, ?, ?)", digest, page["id"], page["url"], time.time())
+        self._x("DELETE FROM media_index WHERE used < ?", time.time() - DEDUP_TTL)
+        self._x("DELETE FROM media_index WHERE digest IN "
+                "(SELECT digest FROM media_index ORDER BY used DESC LIMIT -1 OFFSET ?)", DEDUP_MAX)
+
+journal = Journal(JOURNAL_PATH)
+
+def _file_digest(paths: list) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for fp in paths:
+        with open(fp, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        h.update(b"\0")
+    return h.hexdigest()
+
+async def fingerprint(paths: list) -> str:
+    """一个文件或一组文件（相册）的内容指纹，在线程池中计算；去重关闭时返回 None"""
+    if DEDUP_MODE == "off": return None
+    return await asyncio.get_running_loop().run_in_executor(None, _file_digest, paths)
+
+def link_block(page_id: str):
+    return {"object":"block","type":"link_to_page","link_to_page":{"type":"page_id","page_id":page_id}}
+
+async def handle_duplicate(digest: str, title: str) -> bool:
+    """内容已上传过时按 DEDUP_MODE 处理并返回 True，调用方随后删除本地文件"""
+    prev = journal.seen(digest)
+    if not prev:
+        return False
+    if DEDUP_MODE == "skip":
+        log.info("♻️ 内容与已有页面重复，跳过上传：%s", prev["url"])
+    else:
+        try:
+            page = await _create_page(title, [link_block(prev["id"])])
+        except aiohttp.ClientResponseError as e:
+            # 已有页面在另一个集成/数据库中，当前 token 无权链接
+            if e.status not in (400, 404): raise
+            log.warning("无法链接到已有页面 %s（%s），按新内容上传", prev["url"], e.status)
+            return False
+        log.info("♻️ 内容与已有页面重复，已创建链接页面 %s → %s", page["url"], prev["url"])
+    return True
+
+async def upload_file(fp: Path, mime: str, resumable: bool = True) -> str:
+    """上传单个文件到 Notion，返回 file_upload id；大文件按分块并发上传，
+    resumable 时优先从日志中的 file_upload 续传，只补发未确认的分块"""
+    st=fp.stat()
+    rec=journal.lookup(fp,st) if resumable else None
+    if rec:
+        log.info("从日志续传 %s：已完成 %d/%d 块", fp.name, len(rec["done"]), rec["parts"])
+        try:
+            return await _upload_parts(fp,mime,st,rec,resumable)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in (400, 404): raise
+            log.warning("续传 %s 失败（%s），重新上传", fp.name, e.status)
+            journal.forget(fp)
+    return await _upload_parts(fp,mime,st,None,resumable)
+
+async def _upload_parts(fp: Path, mime: str, st, rec: dict, resumable: bool) -> str:
+    sz=st.st_size; multi=sz>SINGLE_LIMIT
+    parts=math.ceil(sz/PART_SIZE) if multi else 1
+    if rec is None:
+        rec=await _create(fp.name,mime,multi,parts); rec|={"completed":False,"done":set()}
+        if resumable: journal.begin(fp,st,rec,parts)
+    fid,url=rec["id"],rec["upload_url"]
+    if rec["completed"]:
+        return fid
+    if not multi:
+        await _send(url,1,fp,0,sz,mime)
+        journal.completed(fid)
+        return fid
+    
+    t0=time.monotonic(); sem=asyncio.Semaphore(PART_CONCURRENCY)
+    todo=[i for i in range(1,parts+1) if i not in rec["done"]]
+    async def send_part(i):
+        off=(i-1)*PART_SIZE
+        async with sem: await _send(url,i,fp,off,min(PART_SIZE,sz-off),mime)
+        journal.part_done(fid,i)
+    tasks=[asyncio.create_task(send_part(i)) for i in todo]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # 任一分块失败则取消其余分块，不调用 complete
+        for t in tasks: t.cancel()
+        raise
+    await _complete(fid)
+    journal.completed(fid)
+    sent=sum(min(PART_SIZE,sz-(i-1)*PART_SIZE) for i in todo)
+    dt=max(time.monotonic()-t0,1e-6)
+    log.info("%s 分块上传完成：%d 块，%.1f MB，%.2f MB/s（并发 %d）",
+             fp.name, len(todo), sent/1048576, sent/1048576/dt, PART_CONCURRENCY)
+    return fid
+
+async def upload_file_with_retry(fp: Path, mime: str) -> str:
+    """单个文件失败时只重试该文件（借助日志从已确认的分块继续），带抖动指数退避"""
+    for attempt in range(FILE_RETRIES + 1):
+        try:
+            return await upload_file(fp, mime)
+        except Exception as e:
+            if attempt == FILE_RETRIES: raise
+            delay = _backoff(attempt + 2)
+            log.warning(f"文件 {fp.name} 上传失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {e}")
+            await asyncio.sleep(delay)
+
+# ── 图片优化（可选）──────────────────
+OPT_FORMATS = {"jpeg": ("JPEG", "image/jpeg", ".jpg"), "png": ("PNG", "image/png", ".png"),
+               "webp": ("WEBP", "image/webp", ".webp")}
+OPT_DIR = Path(tempfile.gettempdir()) / "notion_uploader_opt"
+_opt_pool = None
+
+if OPTIMIZE_IMAGES and Image is None:
+    log.warning("OPTIMIZE_IMAGES 已开启但未安装 Pillow（pip install Pillow），图片将原样上传")
+    OPTIMIZE_IMAGES = False
+
+def _optimize_image(src: str, dst: str, fmt: str, max_dim: int, quality: int) -> bool:
+    """在子进程中执行：按 EXIF 方向摆正、缩小超大图片、转换格式并丢弃 EXIF 等元数据，
+    结果写入 dst；不比原文件小时删除结果并返回 False"""
+    name = OPT_FORMATS[fmt][0]
+    with Image.open(src) as im:
+        icc = im.info.get("icc_profile")  # 保留色彩配置，其余元数据不写入
+        im = ImageOps.exif_transpose(im)
+        if max(im.size) > max_dim:
+            im.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        if name == "JPEG" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGBA")
+            bg = Image.new("RGB", im.size, "white")
+            bg.paste(im, mask=im.getchannel("A"))
+            im = bg
+        elif im.mode == "CMYK":
+            im = im.convert("RGB")
+        kw = {"optimize": True}
+        if icc: kw["icc_profile"] = icc
+        if name == "JPEG": kw |= {"quality": quality, "progressive": True}
+        if name == "WEBP": kw |= {"quality": quality, "method": 4}
+        tmp = dst + ".part"
+        im.save(tmp, name, **kw)
+    if os.path.getsize(tmp) >= os.path.getsize(src):
+        os.unlink(tmp)
+        return False
+    os.replace(tmp, dst)
+    return True
+
+async def optimize_image(fp: Path, mime: str) -> tuple:
+    """按 OPTIMIZE_RULES 在进程池中优化图片，返回 (实际上传的文件, mime)；
+    未启用、类型不在规则中、优化失败或没有变小时返回原文件"""
+    global _opt_pool
+    fmt = OPTIMIZE_RULES.get(mime) if OPTIMIZE_IMAGES else None
+    if fmt not in OPT_FORMATS:
+        return fp, mime
+    _, out_mime, ext = OPT_FORMATS[fmt]
+    st = fp.stat()
+    key = hashlib.blake2b(f"{fp}|{st.st_size}|{st.st_mtime_ns}|{fmt}|{OPTIMIZE_MAX_DIM}|{OPTIMIZE_QUALITY}".encode(),
+                          digest_size=8).hexdigest()
+    dst = OPT_DIR / key / (fp.stem + ext)  # 保留原文件名，Notion 中显示的文件名不变
+    if dst.exists():  # 上次退出前已生成，沿用以便从日志续传
+        return dst, out_mime
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if _opt_pool is None:
+        # 此时 watchdog 和线程池已在运行，fork 多线程进程可能死锁，改用 forkserver（Windows/macOS 上为 spawn）
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _opt_pool = ProcessPoolExecutor(OPTIMIZE_WORKERS, mp_context=multiprocessing.get_context(method))
+    try:
+        with metrics.timer("uploader_stage_seconds", stage="optimize"):
+            smaller = await asyncio.get_running_loop().run_in_executor(
+                _opt_pool, _optimize_image, str(fp), str(dst), fmt, OPTIMIZE_MAX_DIM, OPTIMIZE_QUALITY)
+    except Exception as e:
+        log.warning(f"优化图片 {fp.name} 失败，原样上传: {e}")
+        smaller = False
+    if not smaller:
+        shutil.rmtree(dst.parent, ignore_errors=True)
+        return fp, mime
+    saved = st.st_size - dst.stat().st_size
+    metrics.inc("uploader_optimized_bytes_saved_total", saved)
+    log.info("🗜️ %s 已优化：%.2f → %.2f MB", fp.name, st.st_size / 1048576, (st.st_size - saved) / 1048576)
+    return dst, out_mime
+
+def discard_optimized(src: Path, fp: Path):
+    """删除 optimize_image 生成的临时文件及其续传记录"""
+    if src != fp:
+        journal.forget(src)
+        shutil.rmtree(src.parent, ignore_errors=True)
 
 def f_block(tp,fid): return {"object":"block","type":tp,tp:{"type":"file_upload","file_upload":{"id":fid}}}
 
+def _cover_prop(fid): return {"files": [{"type": "file_upload", "file_upload": {"id": fid}}]}
+
 async def _create_page(title: str, blocks: list, cover_image_id: str = None):
     props = {"名称": {"title": [{"text": {"content": title}}]}}
     if cover_image_id:
-        props["文件和媒体"] = {"files": [{"type": "file_upload", "file_upload": {"id": cover_image_id}}]}
-    return await notion.pages.create(parent={"database_id": NOTION_DB}, properties=props, children=blocks)
+        props["文件和媒体"] = _cover_prop(cover_image_id)
+    body = {"parent": {"database_id": _account().db}, "properties": props, "children": blocks[:PAGE_BATCH]}
+    with metrics.timer("uploader_stage_seconds", stage="create_page"):
+        page = await _api("POST", f"{NOTION_API}/pages", json=body)
+    metrics.inc("uploader_pages_created_total")
+    if len(blocks) > PAGE_BATCH:  # 切段很多的视频
+        await _append_blocks(page["id"], blocks[PAGE_BATCH:])
+    return page
 
 # ── 视频缩略图生成功能 ─────────────────────
+thumb_sem = asyncio.Semaphore(THUMB_CONCURRENCY)
+
 async def generate_video_thumbnail(video_path: Path) -> Path:
-    """为视频生成缩略图，返回缩略图文件路径"""
+    """为视频生成缩略图，返回缩略图文件路径（异步子进程，不阻塞事件循环）"""
+    fd, tmp = tempfile.mkstemp(prefix=f"{video_path.stem}_", suffix="_thumbnail.jpg")
+    os.close(fd)
+    thumbnail_path = Path(tmp)
     try:
-        # 创建临时文件用于保存缩略图
-        temp_dir = Path(tempfile.gettempdir())
-        thumbnail_path = temp_dir / f"{video_path.stem}_thumbnail.jpg"
-        
-        # 使用ffmpeg生成第一帧缩略图
+        # 只解码关键帧，取第一帧并限制输出分辨率
         cmd = [
-            'ffmpeg', 
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-skip_frame', 'nokey',
             '-i', str(video_path),
-            '-vframes', '1',  # 只取第一帧
+            '-frames:v', '1',
+            '-vf', f"scale='min({THUMB_MAX_WIDTH},iw)':-2",
+            '-q:v', '3',
             '-y',  # 覆盖输出文件
             str(thumbnail_path)
         ]
         
-        log.info(f"正在为视频 {video_path.name} 生成缩略图...")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        async with thumb_sem:
+            log.info(f"正在为视频 {video_path.name} 生成缩略图...")
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            try:
+                with metrics.timer("uploader_stage_seconds", stage="thumbnail"):
+                    _, err = await asyncio.wait_for(proc.communicate(), THUMB_TIMEOUT)
+            except asyncio.TimeoutError:
+                proc.kill(); await proc.wait()
+                log.error(f"ffmpeg 生成缩略图超时（{THUMB_TIMEOUT} 秒）: {video_path.name}")
+                thumbnail_path.unlink(missing_ok=True)
+                return None
+            except BaseException:
+                # 任务被取消（页面已用图片封面、上传失败等）：结束 ffmpeg，临时文件由外层删除
+                proc.kill(); await proc.wait()
+                raise
         
-        if result.returncode == 0 and thumbnail_path.exists():
+        if proc.returncode == 0 and thumbnail_path.stat().st_size > 0:
             log.info(f"缩略图生成成功: {thumbnail_path.name}")
             return thumbnail_path
         else:
-            log.error(f"ffmpeg生成缩略图失败: {result.stderr}")
+            log.error(f"ffmpeg生成缩略图失败: {err.decode(errors='replace').strip()}")
+            thumbnail_path.unlink(missing_ok=True)
             return None
             
     except Exception as e:
         log.error(f"生成缩略图时出错: {e}")
+        thumbnail_path.unlink(missing_ok=True)
         return None
+    except BaseException:
+        thumbnail_path.unlink(missing_ok=True)
+        raise
 
 async def upload_thumbnail_for_media(media_files: list) -> str:
     """为媒体文件生成并上传缩略图到Notion，返回缩略图文件ID"""
@@ -103,26 +801,9 @@ async def upload_thumbnail_for_media(media_files: list) -> str:
             return None
         
         try:
-            # 使用独立的会话上传缩略图到Notion
-            async with aiohttp.ClientSession() as thumb_sess:
-                mime = "image/jpeg"
-                sz = thumbnail_path.stat().st_size
-                multi = sz > SINGLE_LIMIT
-                parts = math.ceil(sz / PART_SIZE) if multi else 1
-                
-                up = await _create(thumb_sess, thumbnail_path.name, mime, multi, parts)
-                fid, url = up["id"], up["upload_url"]
-                
-                if multi:
-                    with open(thumbnail_path, "rb") as f:
-                        for i in range(1, parts + 1):
-                            await _send(thumb_sess, url, i, f.read(PART_SIZE), mime)
-                    await _complete(thumb_sess, fid)
-                else:
-                    await _send(thumb_sess, url, 1, thumbnail_path.read_bytes(), mime)
-                
-                log.info(f"缩略图上传成功，文件ID: {fid}")
-                return fid
+            fid = await upload_file(thumbnail_path, "image/jpeg", resumable=False)
+            log.info(f"缩略图上传成功，文件ID: {fid}")
+            return fid
             
         finally:
             # 删除临时缩略图文件
@@ -134,46 +815,280 @@ async def upload_thumbnail_for_media(media_files: list) -> str:
         log.error(f"处理缩略图时出错: {e}")
         return None
 
+# ── 超大视频切段 ─────────────────────
+async def _run_ffmpeg(cmd: list, timeout: float = None) -> str:
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except BaseException:
+        proc.kill(); await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f"{cmd[0]} 失败: {err.decode(errors='replace').strip()}")
+    return out.decode()
+
+async def _video_index(fp: Path) -> tuple:
+    """读取视频流的包索引（只读不解码）：返回 (时长, [(关键帧相对起始的时间, 解码顺序中此前的视频包数)], 视频包总数)"""
+    info = dict(l.split("=", 1) for l in (await _run_ffmpeg(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=start_time,duration', '-of', 'default=nw=1', str(fp)],
+        THUMB_TIMEOUT)).splitlines() if "=" in l)
+    t0 = float(info["start_time"]) if info.get("start_time", "N/A") != "N/A" else 0.0
+    out = await _run_ffmpeg(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+                             '-of', 'csv=p=0', str(fp)])
+    kfs, n = [], 0
+    for line in out.splitlines():
+        t, _, flags = line.partition(",")
+        if "K" in flags and t not in ("", "N/A"):
+            kfs.append((float(t) - t0, n))
+        n += 1
+    return float(info["duration"]), kfs, n
+
+async def split_video(fp: Path, limit: int, margin: float = 0.9):
+    """异步生成器：用 ffmpeg 流复制（不重新编码）在关键帧处把视频切成不超过 limit 字节的片段。
+    按调用方的进度逐段切：-ss 定位到段首关键帧，-frames:v 按解码顺序截到下一段的关键帧之前，各段不重叠；
+    调用方上传当前段时只预先切好下一段，磁盘上最多同时存在两段。超限的片段按实际码率缩短后重切"""
+    duration, kfs, total = await _video_index(fp)
+    if not kfs:
+        raise RuntimeError(f"{fp.name} 没有找到关键帧，无法切分")
+    times = [t for t, _ in kfs]
+    size = fp.stat().st_size
+    seg_time = duration * limit * margin / size  # 按平均码率估算，留出余量
+    tmp = Path(tempfile.mkdtemp(prefix=f"{fp.stem}_seg_"))
+    log.info("%s 超过单文件上限（%.0f MB > %.0f MB），按每段约 %.0f 秒切分上传",
+             fp.name, size / 1048576, limit / 1048576, seg_time)
+
+    async def cut(a: int, n: int) -> tuple:
+        """从第 a 个关键帧开始切第 n 段，返回 (片段, 下一段的起始关键帧序号)"""
+        end = times[a] + seg_time
+        while True:
+            b = max(a + 1, bisect.bisect_right(times, end) - 1)  # 不超过目标时长的最后一个关键帧
+            frames = (kfs[b][1] if b < len(kfs) else total) - kfs[a][1]
+            dst = tmp / f"{fp.stem}_{n:03d}{fp.suffix}"
+            cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y']
+            if a: cmd += ['-ss', f"{times[a] + 0.001:.3f}"]  # 略过关键帧时间的舍入误差，定位到该关键帧
+            cmd += ['-i', str(fp), '-map', '0:v', '-map', '0:a?', '-c', 'copy', '-frames:v', str(frames), str(dst)]
+            await _run_ffmpeg(cmd)
+            got = dst.stat().st_size
+            if got <= limit:
+                return dst, b
+            dst.unlink()
+            if b == a + 1:
+                raise RuntimeError(f"{fp.name} 无法在关键帧处切分到 {limit / 1048576:.0f} MB 以内")
+            span = (times[b] if b < len(kfs) else duration) - times[a]
+            end = min(times[a] + span * limit * margin / got, times[b - 1])
+
+    task = asyncio.create_task(cut(0, 1))
+    n = 1
+    try:
+        while task:
+            seg, a = await task
+            n += 1
+            task = asyncio.create_task(cut(a, n)) if a < len(kfs) else None
+            yield seg
+    finally:
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+async def upload_video_segments(fp: Path, mime: str, upload) -> list:
+    """边切边传，返回按顺序排列的各段 file_upload id"""
+    fids = []
+    async for seg in split_video(fp, MAX_FILE_SIZE):
+        try:
+            fids.append(await upload(seg, mime))
+            log.info("%s 第 %d 段上传完成（%.1f MB）", fp.name, len(fids), seg.stat().st_size / 1048576)
+        finally:
+            journal.forget(seg)
+            seg.unlink(missing_ok=True)
+    return fids
+
+async def upload_media(fp: Path, mime: str, upload=upload_file_with_retry) -> tuple:
+    """上传前检查大小：超过 MAX_FILE_SIZE 的视频切段上传，其他超限文件直接报错，不再白白传输；
+    图片按需先优化。返回 (file_upload id 列表, 实际上传的 mime)"""
+    size = fp.stat().st_size
+    if MAX_FILE_SIZE and size > MAX_FILE_SIZE:
+        if "video" not in mime:
+            raise ValueError(f"{fp.name}（{size / 1048576:.0f} MB）超过单文件上限 {MAX_FILE_SIZE / 1048576:.0f} MB，且不是视频，无法切分")
+        return await upload_video_segments(fp, mime, upload), mime
+    src, mime = await optimize_image(fp, mime)
+    try:
+        return [await upload(src, mime)], mime
+    finally:
+        discard_optimized(src, fp)
+
+async def _append_blocks(page_id: str, blocks: list):
+    for i in range(0, len(blocks), PAGE_BATCH):
+        with metrics.timer("uploader_stage_seconds", stage="append"):
+            await _api("PATCH", f"{NOTION_API}/blocks/{page_id}/children", json={"children": blocks[i:i + PAGE_BATCH]})
+
+async def _set_cover(page: dict, fid: str):
+    await _api("PATCH", f"{NOTION_API}/pages/{page['id']}", json={"properties": {"文件和媒体": _cover_prop(fid)}})
+
+class PageBuilder:
+    """渐进式建页：第一个文件就绪即创建页面，之后的块严格按原顺序、每批最多 100 个追加。
+    add() 可乱序调用，只有从 next 开始连续就绪的块才会被发送；状态跨整体重试保留，
+    并记入日志（path），进程重启或其他实例接管时从日志恢复"""
+    def __init__(self, title: str, path: Path = None):
+        self.title = title
+        self.path = path
+        self.page = None
+        self.ready = {}   # 序号 → block 列表（切段视频有多个），None 表示跳过的文件
+        self.next = 0     # 下一个待发送的序号
+        self.images = {}  # 序号 → 图片 file_upload id，序号最小的作为封面
+        self.cover_set = False
+        self.count = 0
+        self.last_flush = 0.0
+        self._lock = asyncio.Lock()
+
+    def restore(self, state: dict):
+        self.page = {"id": state["id"], "url": state["url"]}
+        self.next = self.count = state["next"]
+        self.cover_set = state["cover"]
+
+    def _save(self):
+        if self.path is not None and self.page is not None:
+            journal.page_progress(self.path, self.page, self.next, self.cover_set)
+
+    async def add(self, idx: int, blocks: list, image_id: str = None):
+        if idx < self.next:
+            return  # 重试时已发送过的块
+        self.ready[idx] = blocks
+        if image_id: self.images[idx] = image_id
+        if self.page is None or time.monotonic() - self.last_flush >= APPEND_INTERVAL or len(self.ready) >= PAGE_BATCH:
+            await self.flush()
+
+    def _peek(self):
+        blocks, nxt = [], self.next
+        while nxt in self.ready:
+            items = self.ready[nxt] or []
+            if blocks and len(blocks) + len(items) > PAGE_BATCH:
+                break
+            blocks += items
+            nxt += 1
+        return blocks, nxt
+
+    async def flush(self):
+        async with self._lock:
+            while True:
+                blocks, nxt = self._peek()
+                if nxt == self.next:
+                    break
+                if blocks and self.page is None:
+                    cover = self.images.get(0)
+                    self.page = await _create_page(self.title, blocks, cover)
+                    self.cover_set = cover is not None
+                    log.info("相册页面已创建：%s", self.page['url'])
+                elif blocks:
+                    await _append_blocks(self.page["id"], blocks)
+                # 请求成功后才推进，失败时这些块保留到下一次重试
+                for i in range(self.next, nxt): self.ready.pop(i)
+                self.next = nxt
+                self.count += len(blocks)
+                self.last_flush = time.monotonic()
+                self._save()
+
+    async def finish(self, thumb_task=None) -> dict:
+        """发送剩余块并补写封面（第一张图片，或视频缩略图），返回页面；没有任何块时返回 None"""
+        await self.flush()
+        if self.page is None or self.cover_set:
+            if thumb_task: thumb_task.cancel()
+            return self.page
+        cover_id = self.images[min(self.images)] if self.images else None
+        if cover_id and thumb_task: thumb_task.cancel()
+        if cover_id is None and thumb_task:
+            cover_id = await thumb_task
+        if cover_id:
+            try:
+                await _set_cover(self.page, cover_id)
+                self.cover_set = True
+                self._save()
+            except Exception as e:
+                log.warning(f"设置相册封面失败: {e}")
+        return self.page
+
+class AlbumProgress:
+    """相册处理进度，跨整体重试保留：已上传文件的 file_upload id、渐进创建中的页面和内容指纹"""
+    def __init__(self):
+        self.uploaded = {}
+        self.builder = None
+        self.digest = None
+
+def start_thumbnail(media_files: list):
+    """媒体中有视频时在后台生成并上传缩略图，与主文件传输并行；返回任务或 None"""
+    if not any("video" in (mimetypes.guess_type(fp)[0] or "") for fp in media_files):
+        return None
+    return asyncio.create_task(upload_thumbnail_for_media(media_files))
+
+async def create_page_with_cover(title: str, blocks: list, cover_id: str = None, thumb_task=None):
+    """创建页面；没有图片封面时使用缩略图任务的结果。
+    DEFER_COVER 开启且缩略图尚未就绪时先创建页面，再补写"文件和媒体"封面"""
+    if cover_id or thumb_task is None:
+        if thumb_task: thumb_task.cancel()
+        return await _create_page(title, blocks, cover_id)
+    if not (DEFER_COVER and not thumb_task.done()):
+        return await _create_page(title, blocks, await thumb_task)
+    
+    page = await _create_page(title, blocks)
+    thumbnail_id = await thumb_task
+    if thumbnail_id:
+        try:
+            await _set_cover(page, thumbnail_id)
+            log.info("已为页面补充封面: %s", page['url'])
+        except Exception as e:
+            log.warning(f"补充页面封面失败: {e}")
+    return page
+
 # ── 核心上传逻辑 ─────────────────────
 
 async def upload_single_file(fp: Path):
     log.info(f"处理单个文件: {fp.name}")
     try:
-        mime,_=mimetypes.guess_type(fp); mime=mime or "application/octet-stream"
-        sz=fp.stat().st_size; multi=sz>SINGLE_LIMIT
-        parts=math.ceil(sz/PART_SIZE) if multi else 1
-        
-        async with aiohttp.ClientSession() as sess:
-            up=await _create(sess,fp.name,mime,multi,parts); fid,url=up["id"],up["upload_url"]
-            if multi:
-                with open(fp,"rb") as f:
-                    for i in range(1,parts+1): await _send(sess,url,i,f.read(PART_SIZE),mime)
-                await _complete(sess,fid)
-            else: await _send(sess,url,1,fp.read_bytes(),mime)
+        digest=await fingerprint([fp])
+        page=journal.page_state(fp)
+        if page:
+            log.info("文件 %s 的页面此前已创建（%s），只做清理", fp.name, page['url'])
+        elif await handle_duplicate(digest, fp.stem):
+            fp.unlink()
+            log.info("已删除本地文件 %s", fp.name)
+            return
+        else:
+            mime,_=mimetypes.guess_type(fp); mime=mime or "application/octet-stream"
+            # 如果是视频文件，缩略图与视频上传同时进行
+            thumb_task = start_thumbnail([fp])
+            try:
+                fids,mime=await upload_media(fp,mime,upload_file)
+            except BaseException:
+                if thumb_task: thumb_task.cancel()
+                raise
             
             kind="video" if "video" in mime else "image" if "image" in mime else "file"
             
-            # 如果是视频文件，生成缩略图
-            thumbnail_id = None
-            if "video" in mime:
-                thumbnail_id = await upload_thumbnail_for_media([fp])
-            
-            page = await _create_page(fp.stem, [f_block(kind,fid)], thumbnail_id)
+            page = await create_page_with_cover(fp.stem, [f_block(kind,fid) for fid in fids], thumb_task=thumb_task)
+            journal.page_progress(fp, page, 1, True)
             log.info("✅ 单文件上传成功！ %s", page['url'])
+        journal.forget(fp)
+        journal.remember(digest, page)
         
         fp.unlink()
+        journal.page_done(fp)
         log.info("已删除本地文件 %s", fp.name)
     except Exception as e:
         log.error(f"处理文件 {fp.name} 时出错: {e}", exc_info=True)
+    finally:
+        processing_dirs.discard(str(fp))
 
-async def upload_dir(dirp: Path):
+async def upload_dir(dirp: Path, progress: AlbumProgress = None):
+    """progress 保存已上传文件的 id 和已创建的页面，整体重试时复用，不再重传或重复建页"""
+    progress = AlbumProgress() if progress is None else progress
     log.info(f"开始处理文件夹: {dirp.name}")
     try:
         if not dirp.exists():
             log.warning(f"文件夹 {dirp.name} 已不存在，跳过处理")
             return
             
-        media = sorted([p for p in dirp.iterdir() if p.is_file()])
+        media = sorted([p for p in dirp.iterdir() if p.is_file() and p.name != STABLE_MARKER])
         if not media: 
             log.info(f"文件夹 {dirp.name} 为空，删除")
             shutil.rmtree(dirp, ignore_errors=True)
@@ -181,175 +1096,770 @@ async def upload_dir(dirp: Path):
         
         log.info(f"文件夹 {dirp.name} 包含 {len(media)} 个文件: {[f.name for f in media]}")
         
-        blocks = []
-        first_image_id = None
-        async with aiohttp.ClientSession() as sess:
-            for fp in media:
-                # 添加文件存在性检查
-                if not fp.exists():
-                    log.warning(f"文件 {fp.name} 不存在，跳过")
-                    continue
-                    
-                log.info(f"处理文件: {fp.name}")
-                mime,_=mimetypes.guess_type(fp); mime=mime or "application/octet-stream"
-                sz=fp.stat().st_size; multi=sz>SINGLE_LIMIT
-                parts=math.ceil(sz/PART_SIZE) if multi else 1
-                up=await _create(sess,fp.name,mime,multi,parts); fid,url=up["id"],up["upload_url"]
-                if multi:
-                    with open(fp,"rb") as f:
-                        for i in range(1,parts+1): await _send(sess,url,i,f.read(PART_SIZE),mime)
-                    await _complete(sess,fid)
-                else: await _send(sess,url,1,fp.read_bytes(),mime)
-                
-                kind="video" if "video" in mime else "image" if "image" in mime else "file"
-                blocks.append(f_block(kind,fid))
-                
-                # 记录第一张图片的ID用于封面
-                if first_image_id is None and "image" in mime:
-                    first_image_id = fid
+        # 使用第一个文件的文件名作为页面标题
+        title = media[0].stem if media else dirp.name
+        if progress.digest is None:
+            progress.digest = await fingerprint(media)  # 只在第一次尝试时读取全部文件
+        digest = progress.digest
+        if progress.builder is None:
+            state = journal.page_state(dirp)
+            if state is None and await handle_duplicate(digest, title):
+                shutil.rmtree(dirp, ignore_errors=True)
+                log.info("已删除目录及所有文件: %s", dirp.name)
+                return
+            progress.builder = PageBuilder(title, dirp)
+            if state:
+                progress.builder.restore(state)
+                log.info("从日志恢复相册页面 %s，已写入 %d/%d 个文件", state['url'], state['next'], len(media))
+        builder = progress.builder
+        
+        # 没有图片可做封面时，视频缩略图与文件上传同时进行
+        has_image = any("image" in (mimetypes.guess_type(fp)[0] or "") for fp in media)
+        thumb_task = None if has_image else start_thumbnail(media)
+        try:
+            await _upload_album_files(media, progress.uploaded, builder)
+            page = await builder.finish(thumb_task)
+        except BaseException:
+            if thumb_task: thumb_task.cancel()
+            raise
         
         # 如果没有处理任何文件，直接删除目录
-        if not blocks:
+        if page is None:
             log.warning(f"文件夹 {dirp.name} 中没有有效文件，删除目录")
             shutil.rmtree(dirp, ignore_errors=True)
             return
         
-        # 如果没有图片作为封面，生成视频缩略图
-        if first_image_id is None:
-            # 重新获取存在的媒体文件用于生成缩略图
-            existing_media = [p for p in media if p.exists()]
-            if existing_media:
-                thumbnail_id = await upload_thumbnail_for_media(existing_media)
-                if thumbnail_id:
-                    first_image_id = thumbnail_id
-        
-        # 使用第一个文件的文件名作为页面标题
-        title = media[0].stem if media else dirp.name
-        page = await _create_page(title, blocks, first_image_id)
-        log.info("✅ 相册上传成功！包含 %d 个文件，页面：%s", len(blocks), page['url'])
+        log.info("✅ 相册上传成功！包含 %d 个文件，页面：%s", builder.count, page['url'])
+        for fp in media: journal.forget(fp)
+        journal.remember(digest, page)
         
         shutil.rmtree(dirp, ignore_errors=True)
+        journal.page_done(dirp)
         log.info("已删除目录及所有文件: %s", dirp.name)
     except Exception as e:
         log.error(f"处理目录 {dirp.name} 时出错: {e}", exc_info=True)
         raise  # 重新抛出异常供重试机制处理
 
+async def _upload_album_files(media: list, uploaded: dict, builder: PageBuilder):
+    """并发上传相册文件（最多 ALBUM_CONCURRENCY 个），每个文件完成后交给 builder 按原顺序加入页面"""
+    sem = asyncio.Semaphore(ALBUM_CONCURRENCY)
+    
+    async def upload_one(idx, fp):
+        # 添加文件存在性检查
+        if not fp.exists():
+            log.warning(f"文件 {fp.name} 不存在，跳过")
+            await builder.add(idx, None)
+            return
+        
+        mime,_=mimetypes.guess_type(fp); mime=mime or "application/octet-stream"
+        if fp not in uploaded:
+            async with sem:
+                log.info(f"处理文件: {fp.name}")
+                uploaded[fp]=await upload_media(fp,mime)
+        fids,mime=uploaded[fp]
+        
+        kind="video" if "video" in mime else "image" if "image" in mime else "file"
+        # 记录图片的ID用于封面；切段的视频在同一位置占多个块
+        await builder.add(idx, [f_block(kind,fid) for fid in fids], fids[0] if "image" in mime else None)
+    
+    # 已经发送到页面的文件跳过；某个文件失败时让其余文件继续完成，供整体重试复用
+    results = await asyncio.gather(*[upload_one(i, fp) for i, fp in enumerate(media) if i >= builder.next],
+                                   return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException): raise r
+
 async def upload_dir_with_retry(dirp: Path, max_retries=2):
     """带重试机制的目录上传函数"""
     dir_name = str(dirp)
+    progress = AlbumProgress()  # 跨重试保留已上传文件的 id 和已创建的页面
     
-    for attempt in range(max_retries + 1):
+    try:
+        for attempt in range(max_retries + 1):
+            try:
+                await upload_dir(dirp, progress)
+                return  # 成功则返回
+            except Exception as e:
+                if attempt < max_retries:
+                    log.warning(f"处理目录 {dirp.name} 失败，第 {attempt + 1} 次重试（已上传 {len(progress.uploaded)} 个文件将复用）... 错误: {e}")
+                    await asyncio.sleep(5)  # 等待5秒后重试
+                else:
+                    log.error(f"处理目录 {dirp.name} 失败，已达到最大重试次数，跳过。错误: {e}")
+                    # 即使失败也要清理目录和处理锁
+                    if dirp.exists():
+                        shutil.rmtree(dirp, ignore_errors=True)
+                        log.info(f"已删除目录: {dirp.name}")
+                    journal.page_done(dirp)
+    finally:
+        # 无论成功失败都要移除处理锁
+        if dir_name in processing_dirs:
+            processing_dirs.remove(dir_name)
+            log.debug(f"已移除目录 {dirp.name} 的处理锁")
+
+# ── 多实例租约 ───────────────────────
+class LeaseManager:
+    """跨进程任务认领：WATCH_DIR/.leases 下每个任务一个租约文件，用 O_EXCL 原子创建，
+    只有创建成功的实例处理该任务。持有者每 LEASE_TTL/3 秒刷新 mtime；超过 LEASE_TTL 未刷新
+    视为实例已失效，其他实例先把过期租约原子改名（只有一个能成功）再重新认领。
+    未开启 MULTI_INSTANCE 时 claim() 总是成功"""
+    def __init__(self, dirp: Path, owner: str, ttl: float):
+        self.dir = dirp
+        self.owner = owner
+        self.ttl = ttl
+        self.held = set()
+
+    def _file(self, path: Path) -> Path:
+        return self.dir / (hashlib.blake2b(path.name.encode(), digest_size=16).hexdigest() + ".lease")
+
+    @staticmethod
+    def _read(f: Path) -> tuple:
+        """返回 (持有者, 任务名)"""
+        owner, _, name = f.read_text(encoding="utf-8").partition("\n")
+        return owner, name
+
+    def _expired(self, f: Path) -> bool:
+        return time.time() - f.stat().st_mtime > self.ttl
+
+    def claim(self, path: Path) -> bool:
+        if not MULTI_INSTANCE:
+            return True
+        self.dir.mkdir(parents=True, exist_ok=True)
+        f = self._file(path)
+        for _ in range(2):
+            try:
+                fd = os.open(f, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    if self._read(f)[0] == self.owner:
+                        # 本实例之前持有的租约（可能已过期）：先刷新再读回，确认没有被同时接管
+                        os.utime(f)
+                        if self._read(f)[0] != self.owner:
+                            return False
+                        break
+                    if not self._expired(f):
+                        return False
+                    stale = f.with_name(f"{f.name}.{self.owner}.stale")
+                    os.rename(f, stale)  # 多个实例同时接管时只有一个改名成功
+                    if not self._expired(stale):
+                        os.replace(stale, f)  # 持有者在改名前刚刚续期，还给它
+                        return False
+                    os.unlink(stale)
+                    log.warning("接管已过期的任务租约: %s", path.name)
+                except FileNotFoundError:
+                    pass  # 租约刚被释放或被其他实例接管，重试一次
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                fh.write(f"{self.owner}\n{path.name}")
+            break
+        else:
+            return False
+        self.held.add(path)
+        return True
+
+    def release(self, path: Path):
+        if path not in self.held:
+            return
+        self.held.discard(path)
+        try:
+            f = self._file(path)
+            if self._read(f)[0] == self.owner:
+                f.unlink()
+        except FileNotFoundError:
+            pass
+
+    def renew(self):
+        for path in list(self.held):
+            f = self._file(path)
+            try:
+                if self._read(f)[0] != self.owner:
+                    raise FileNotFoundError
+                os.utime(f)
+            except FileNotFoundError:
+                self.held.discard(path)
+                log.error("任务 %s 的租约已被其他实例接管（续期超时），可能被重复处理", path.name)
+
+    def sweep(self, debouncer):
+        """过期租约对应的任务仍然存在时重新安排稳定检测，由本实例接管；任务已不存在的租约直接清理"""
+        for f in self.dir.glob("*.lease"):
+            try:
+                owner, name = self._read(f)
+                if owner == self.owner or not self._expired(f):
+                    continue
+                job = WATCH_DIR / name
+                if not job.exists():
+                    f.unlink()
+                elif str(job) not in processing_dirs:
+                    log.info("实例 %s 的任务 %s 租约已过期，准备接管", owner, name)
+                    debouncer.schedule(job)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    async def run(self, debouncer):
+        log.info("多实例模式：实例 %s，租约目录 %s，有效期 %.0f 秒", self.owner, self.dir, self.ttl)
+        while True:
+            try:
+                self.renew()
+                self.sweep(debouncer)
+            except OSError as e:
+                log.warning(f"刷新任务租约出错: {e}")
+            await asyncio.sleep(self.ttl / 3)
+
+leases = LeaseManager(WATCH_DIR / ".leases", INSTANCE_ID, LEASE_TTL)
+
+# ── 上传调度队列 ─────────────────────
+def _job_size(path: Path) -> int:
+    """任务总字节数：单文件取文件大小，相册取目录内文件大小之和"""
+    try:
+        if path.is_file(): return path.stat().st_size
+        with os.scandir(path) as it:
+            return sum(e.stat().st_size for e in it if e.is_file())
+    except OSError:
+        return 0
+
+class UploadScheduler:
+    """有界上传队列：固定数量的 worker 按"小任务优先"取任务。
+    优先级 = 入队时间 + 字节数 / AGING_RATE，排队越久越靠前，大文件不会被小文件无限推迟"""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.running = 0
+        self.active = set()  # 排队或执行中的路径，避免同一任务重复入队
+        self._seq = itertools.count()
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self.tasks: t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    def submit(self, fn, path: Path, size: int):
+        """加入队列（必须在事件循环线程中调用）；多实例的租约在 worker 开始执行时才认领，
+        排队中的任务不占用租约，其他空闲实例可以先处理"""
+        if path in self.active:
+            log.debug("任务 %s 已在队列中，跳过", path.name)
+            return
+        journal.job_start(path)  # 先写日志，失败时任务不会残留在 active 中
+        self.active.add(path)
+        key = time.monotonic() + size / AGING_RATE
+        self.queue.put_nowait((key, next(self._seq), fn, path))
+        log.info("任务 %s（%.1f MB）已加入上传队列，排队 %d，执行中 %d", path.name, size / 1048576, self.depth, self.running)
+
+    @staticmethod
+    def _safe(what: str, fn, path: Path):
+        """租约和日志操作出错（如多实例共享日志时 database is locked）只记录，worker 不能因此退出；
+        残留的日志记录在下次启动时由 resume_jobs 清理"""
         try:
-            await upload_dir(dirp)
-            return  # 成功则返回
+            fn(path)
         except Exception as e:
-            if attempt < max_retries:
-                log.warning(f"处理目录 {dirp.name} 失败，第 {attempt + 1} 次重试... 错误: {e}")
-                await asyncio.sleep(5)  # 等待5秒后重试
-            else:
-                log.error(f"处理目录 {dirp.name} 失败，已达到最大重试次数，跳过。错误: {e}")
-                # 即使失败也要清理目录和处理锁
-                if dirp.exists():
-                    shutil.rmtree(dirp, ignore_errors=True)
-                    log.info(f"已删除目录: {dirp.name}")
+            log.error(f"{what} {path.name} 出错: {e}")
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            _, _, fn, path = item
+            try:
+                claimed = leases.claim(path)
+            except OSError as e:
+                log.error(f"认领任务 {path.name} 的租约出错，{STABLE_QUIET:g} 秒后重试: {e}")
+                asyncio.get_running_loop().call_later(STABLE_QUIET, self.queue.put_nowait, item)
+                self.queue.task_done()
+                continue
+            if not claimed or not path.exists():
+                if claimed:
+                    self._safe("清理任务日志", journal.job_done, path)  # 排队期间已被其他实例处理完
+                else:
+                    log.info("任务 %s 已由其他实例处理，跳过", path.name)
+                self.active.discard(path)
+                processing_dirs.discard(str(path))
+                self._safe("释放租约", leases.release, path)
+                self.queue.task_done()
+                continue
+            self.running += 1
+            try:
+                with use_account(job_account(path)):
+                    await fn(path)
+            except Exception as e:
+                log.error(f"上传任务 {path.name} 异常: {e}", exc_info=True)
+            finally:
+                self.running -= 1
+                self.active.discard(path)
+                self._safe("释放租约", leases.release, path)
+                self.queue.task_done()
+            # 被取消（进程退出）时不会执行到这里，任务保留在日志中等待下次恢复
+            self._safe("清理任务日志", journal.job_done, path)
+
+scheduler = UploadScheduler(UPLOAD_WORKERS)
+
+def resume_jobs():
+    """重新提交上次进程退出时未完成的任务（已稳定，无需再等待）"""
+    for path in journal.jobs():
+        if not path.exists():
+            journal.job_done(path); continue
+        log.info("恢复未完成的任务: %s", path.name)
+        processing_dirs.add(str(path))  # 启动扫描再次发现时跳过，避免合并模式把排队中的文件移走
+        if path.is_dir():
+            scheduler.submit(upload_dir_with_retry, path, _job_size(path))
+        else:
+            scheduler.submit(upload_single_file, path, _job_size(path))
+
+def scan_backlog(debouncer):
+    """启动时扫描 WATCH_DIR 中已存在的文件，按与 StableWatcher 相同的规则送入处理流程（在线程池中运行）"""
+    n_files = n_dirs = 0
+    with os.scandir(WATCH_DIR) as it:
+        for e in it:
+            if e.name.startswith('.'):
+                continue  # 忽略隐藏文件（包括续传日志）
+            if e.is_dir(follow_symlinks=False):
+                debouncer.post("scan", e.path, True); n_dirs += 1
+            elif e.is_file(follow_symlinks=False):
+                debouncer.post("scan", e.path, False); n_files += 1
+    log.info("启动扫描完成：发现 %d 个单文件、%d 个文件夹待处理", n_files, n_dirs)
+
+# ── 稳定检测 ──────────────────────────
+class JobState:
+    """单个任务（根目录文件或相册目录）的稳定检测状态"""
+    def __init__(self):
+        self.quiet = STABLE_QUIET  # 本任务当前的静默期，随观察到的写入间隔自适应增长
+        self.first_seen = self.last_create = time.monotonic()
+        self.snapshot = None
+        self.changed = self.first_seen  # 快照最近一次变化的时间
+        self.open = set()  # 收到 modified（真实写入）但尚未收到 close-write 的文件
+        self.unconfirmed = set()  # 只收到 created 的文件（可能是 watchdog 补发的事件，之后不会有 close-write）
+        self.marked = False  # 已出现完成标记，之后的检查一律立即进行
+
+    def file_created(self):
+        # 相册文件之间的间隔越长，静默期越长，避免把一个相册拆成两个页面
+        now = time.monotonic()
+        gap = now - self.last_create
+        self.last_create = now
+        self.quiet = min(STABLE_DELAY, max(self.quiet, 2 * gap))
+
+def _snapshot(path: Path) -> dict:
+    """路径下所有文件的 (大小, mtime) 快照"""
+    try:
+        if path.is_file():
+            st = path.stat()
+            return {path.name: (st.st_size, st.st_mtime_ns)}
+        snap = {}
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_file() and e.name != STABLE_MARKER:
+                    st = e.stat()
+                    snap[e.name] = (st.st_size, st.st_mtime_ns)
+        return snap
+    except OSError:
+        return None
+
+class Debouncer:
+    """事件循环上的去抖调度器。
+    watchdog 线程只把事件放进线程安全队列；事件的处理、稳定检测状态（stability / pending_dirs /
+    processing_dirs）全部在事件循环线程中完成，无需加锁。每个任务只保留一个截止时间，
+    用小根堆 + 惰性删除管理；同一批事件中对同一任务的多次触发合并为一次重新调度"""
+    def __init__(self, loop):
+        self.inbox = queue.SimpleQueue()
+        self.heap = []
+        self.loop = loop
+        self._wake = asyncio.Event()
+        self._signalled = False
+        self._touched = None
+
+    def post(self, kind: str, src: str, is_dir: bool):
+        """可在任意线程调用"""
+        self.inbox.put((kind, src, is_dir))
+        if not self._signalled:
+            self._signalled = True
+            self.loop.call_soon_threadsafe(self._wake.set)
+
+    def schedule(self, path: Path, delay: float = None):
+        """（重新）安排一次稳定检查；delay 为空时使用该任务的静默期"""
+        key = str(path)
+        # 检查是否已经在处理中
+        if key in processing_dirs:
+            log.debug(f"{path.name} 已在处理中，跳过")
+            return
+        st = stability.setdefault(key, JobState())
+        if st.marked:
+            delay = 0  # 同一批中其他事件不能把完成标记的立即检查推迟回静默期
+        if self._touched is not None and delay is None:
+            self._touched.add(path)  # 批处理结束后统一调度
+            return
+        when = self.loop.time() + (st.quiet if delay is None else delay)
+        pending_dirs[key] = when
+        heapq.heappush(self.heap, (when, key))
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            self._signalled = False
+            self._drain()
+            now = self.loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                when, key = heapq.heappop(self.heap)
+                if pending_dirs.get(key) == when:  # 已被更新的截止时间直接丢弃
+                    del pending_dirs[key]
+                    try:
+                        check_stable(Path(key), self)
+                    except Exception as e:
+                        # 例如共享日志被锁（database is locked）：放开任务，稍后重新检查，调度循环不能退出
+                        log.error(f"稳定检查 {Path(key).name} 出错，{STABLE_QUIET:g} 秒后重试: {e}", exc_info=True)
+                        processing_dirs.discard(key)
+                        self.schedule(Path(key), STABLE_QUIET)
+            if len(self.heap) > 4 * len(pending_dirs) + 64:
+                self.heap = [(w, k) for k, w in pending_dirs.items()]
+                heapq.heapify(self.heap)
+            timeout = self.heap[0][0] - self.loop.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _drain(self):
+        self._touched = set()
+        try:
+            while True:
+                try:
+                    kind, src, is_dir = self.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    handle_event(self, kind, Path(src), is_dir)
+                except Exception as e:
+                    log.error(f"处理文件事件 {src} 出错: {e}", exc_info=True)
         finally:
-            # 无论成功失败都要移除处理锁
-            if dir_name in processing_dirs:
-                processing_dirs.remove(dir_name)
-                log.debug(f"已移除目录 {dirp.name} 的处理锁")
+            touched, self._touched = self._touched, None
+        for path in touched:
+            self.schedule(path)
 
-def schedule_dir_processing(dirp: Path, loop):
-    """延时处理目录，确保所有文件都下载完成"""
-    dir_name = str(dirp)
-    
-    # 检查目录是否已经在处理中
-    if dir_name in processing_dirs:
-        log.debug(f"目录 {dirp.name} 已在处理中，跳过")
+class Coalescer:
+    """合并模式（COALESCE_MODE）：转发大量单条消息时，把同一窗口内写完的根目录单文件合并成一个页面。
+    窗口结束后把文件原子移动到新建的子目录，交给 upload_dir_with_retry 按相册处理；
+    移动失败（已被其他实例取走）的文件跳过。只有一个文件的组仍按单文件上传"""
+    CHAT_RE = re.compile(r"^(-?\d+)_\d+")  # SaveAny 的 {chat_id}_{message_id} 命名
+
+    def __init__(self):
+        self.groups = {}  # 分组键 → (文件列表, 窗口结束的定时器)
+        self._seq = itertools.count(1)
+
+    def _key(self, fp: Path) -> str:
+        if COALESCE_MODE == "window":
+            return "window"
+        m = self.CHAT_RE.match(fp.stem) if COALESCE_MODE == "chat" else None
+        return m[1] if m else None
+
+    def add(self, fp: Path) -> bool:
+        """文件加入合并组返回 True；不参与合并时返回 False，由调用方按单文件处理"""
+        key = self._key(fp)
+        if key is None:
+            return False
+        if key not in self.groups:
+            timer = asyncio.get_running_loop().call_later(COALESCE_WINDOW, self.flush, key)
+            self.groups[key] = ([], timer)
+        files = self.groups[key][0]
+        files.append(fp)
+        if len(files) >= COALESCE_MAX:
+            self.flush(key)
+        return True
+
+    def flush(self, key: str):
+        files, timer = self.groups.pop(key, ([], None))
+        if timer: timer.cancel()
+        if len(files) == 1:
+            scheduler.submit(upload_single_file, files[0], _job_size(files[0]))
+            return
+        if not files:
+            return
+        dirp = WATCH_DIR / f"batch_{key}_{time.strftime('%Y%m%d_%H%M%S')}_{next(self._seq)}"
+        processing_dirs.add(str(dirp))  # 先加锁，监控到新目录时不再重复安排
+        try:
+            dirp.mkdir()
+        except OSError as e:
+            log.error(f"创建合并目录失败，按单文件处理: {e}")
+            processing_dirs.discard(str(dirp))
+            for fp in files: scheduler.submit(upload_single_file, fp, _job_size(fp))
+            return
+        moved = 0
+        for fp in files:
+            try:
+                os.rename(fp, dirp / fp.name)
+                moved += 1
+            except FileNotFoundError:
+                pass
+            processing_dirs.discard(str(fp))
+        log.info("合并 %d 个单文件到 %s，作为一个页面上传", moved, dirp.name)
+        scheduler.submit(upload_dir_with_retry, dirp, _job_size(dirp))
+
+coalescer = Coalescer()
+
+def check_stable(path: Path, debouncer: Debouncer):
+    """静默期结束后检查任务是否写入完成：有完成标记、所有文件已关闭，或两次快照一致"""
+    key = str(path)
+    st = stability.get(key)
+    if st is None or key in processing_dirs:
+        return
+    if not path.exists():
+        stability.pop(key, None)
         return
     
-    # 取消之前的计时器（如果有的话）
-    if dir_name in pending_dirs:
-        pending_dirs[dir_name].cancel()
-        log.debug(f"取消之前的处理计划: {dirp.name}")
+    snap = _snapshot(path)
+    marked = bool(STABLE_MARKER) and path.is_dir() and (path / STABLE_MARKER).exists()
+    if not marked:
+        if not snap:
+            # 空目录：等待文件出现，超过最长静默期后交给 upload_dir 清理
+            if time.monotonic() - st.first_seen < STABLE_DELAY:
+                debouncer.schedule(path)
+                return
+        elif close_events_seen and st.open:
+            # 写入进程异常退出等情况下不会有 close-write，
+            # 内容超过最长静默期没有变化的"未写完"文件视为已写完
+            if snap != st.snapshot:
+                st.snapshot, st.changed = snap, time.monotonic()
+            if time.monotonic() - st.changed < STABLE_DELAY:
+                log.debug("%s 仍有 %d 个文件未写完", path.name, len(st.open))
+                debouncer.schedule(path)
+                return
+            log.info("%s 的 %d 个文件未收到写入完成事件，但已 %.0f 秒无变化，按已写完处理",
+                     path.name, len(st.open), STABLE_DELAY)
+        elif close_events_seen and st.unconfirmed and snap != st.snapshot:
+            # 只有 created 事件的文件（mkdir 后立即写入时 watchdog 补发）：以间隔 STABLE_POLL 的两次快照一致为准
+            st.snapshot = snap
+            debouncer.schedule(path, STABLE_POLL)
+            return
+        elif not (close_events_seen or snap == st.snapshot):
+            # 没有 close-write 事件可用时，以间隔 STABLE_POLL 的两次快照一致为准
+            if st.snapshot is not None:
+                st.quiet = min(STABLE_DELAY, st.quiet * 2)
+            st.snapshot = snap
+            debouncer.schedule(path, STABLE_POLL)
+            return
     
-    # 创建新的计时器
-    def process_dir():
-        if dirp.exists():
-            # 添加到处理中的目录集合
-            processing_dirs.add(dir_name)
-            log.info(f"文件夹 {dirp.name} 稳定 {STABLE_DELAY} 秒，开始处理")
-            loop.call_soon_threadsafe(asyncio.create_task, upload_dir_with_retry(dirp))
-        if dir_name in pending_dirs:
-            del pending_dirs[dir_name]
+    stability.pop(key, None)
+    waited = time.monotonic() - st.first_seen
+    metrics.observe("uploader_stability_wait_seconds", waited)
+    processing_dirs.add(key)
+    if path.is_dir():
+        log.info(f"文件夹 {path.name} 已稳定（等待 {waited:.1f} 秒），开始处理")
+        scheduler.submit(upload_dir_with_retry, path, _job_size(path))
+    else:
+        log.info(f"文件 {path.name} 已写入完成（等待 {waited:.1f} 秒），开始处理")
+        if COALESCE_MODE == "off" or not coalescer.add(path):
+            scheduler.submit(upload_single_file, path, _job_size(path))
+
+def _job_of(path: Path) -> Path:
+    """事件所属的任务：根目录文件本身，或 WATCH_DIR 的直接子目录（隐藏目录如 .leases 除外）"""
+    if path.parent == WATCH_DIR:
+        return path
+    if path.parent.parent == WATCH_DIR and not path.parent.name.startswith('.'):
+        return path.parent
+    return None
+
+def handle_event(debouncer: Debouncer, kind: str, path: Path, is_dir: bool):
+    """在事件循环线程中处理一个文件事件"""
+    global close_events_seen
+    if STABLE_MARKER and path.name == STABLE_MARKER and path.parent.parent == WATCH_DIR:
+        # 完成标记本身的 modified/closed 事件不参与写入跟踪（标记名不以 . 开头时也会上报）
+        if kind == "created" and str(path.parent) not in processing_dirs:
+            log.info("检测到目录 %s 的完成标记", path.parent.name)
+            stability.setdefault(str(path.parent), JobState()).marked = True
+            debouncer.schedule(path.parent, 0)
+        return
+    if kind == "closed":
+        # close-write：文件写入完成，尽快检查整个任务是否稳定
+        close_events_seen = True
+        if is_dir or path.name.startswith('.'):
+            return
+        job = _job_of(path)
+        st = stability.get(str(job)) if job is not None else None
+        if st is None:
+            return
+        st.open.discard(path.name)
+        st.unconfirmed.discard(path.name)
+        if not st.open:
+            debouncer.schedule(job, min(st.quiet, STABLE_POLL) if job == path else None)
+        return
     
-    timer = Timer(STABLE_DELAY, process_dir)
-    pending_dirs[dir_name] = timer
-    timer.start()
-    log.info(f"文件夹 {dirp.name} 计划在 {STABLE_DELAY} 秒后处理")
+    if path.name.startswith('.'):
+        return  # 忽略隐藏文件
+    
+    if kind == "scan":
+        # 启动扫描发现的已有文件/目录
+        debouncer.schedule(path)
+    elif is_dir:
+        if kind == "created" and path.parent == WATCH_DIR:
+            # 目录创建 - 安排稳定检测
+            log.info("检测到新目录 %s", path.name)
+            debouncer.schedule(path)
+    else:
+        job = _job_of(path)
+        if job is None or str(job) in processing_dirs:
+            return
+        st = stability.setdefault(str(job), JobState())
+        if kind == "created":
+            if job == path:
+                log.info("检测到根目录单文件 %s，写入完成后单独处理", path.name)
+            else:
+                log.info("检测到目录 %s 中新文件 %s，重新安排处理", job.name, path.name)
+            st.file_created()
+            st.unconfirmed.add(path.name)
+        else:
+            st.open.add(path.name)
+            st.unconfirmed.discard(path.name)
+        debouncer.schedule(job)
 
 # ── Watchdog (优化版本) ──────────────────────────
 class StableWatcher(FileSystemEventHandler):
-    def __init__(self, loop):
-        self.loop = loop
+    """只负责把事件转交给事件循环上的 Debouncer，不在 watchdog 线程中修改任何状态"""
+    def __init__(self, debouncer: Debouncer):
+        self.debouncer = debouncer
     
     def on_created(self, ev):
-        path = Path(ev.src_path)
-        if path.name.startswith('.'): 
-            return  # 忽略隐藏文件
-            
-        if ev.is_directory:
-            # 目录创建 - 安排延时处理
-            log.info("检测到新目录 %s", path.name)
-            schedule_dir_processing(path, self.loop)
-        else:
-            # 检查是根目录文件还是子目录文件
-            if path.parent == WATCH_DIR:
-                log.info("检测到根目录单文件 %s，将单独处理", path.name)
-                Timer(1.0, lambda: self.loop.call_soon_threadsafe(asyncio.create_task, upload_single_file(path))).start()
-            else:
-                # 子目录中的文件 - 重新安排该目录的处理
-                parent_dir = path.parent
-                if parent_dir.parent == WATCH_DIR:  # 确保是我们监控的直接子目录
-                    log.info("检测到目录 %s 中新文件 %s，重新安排处理", parent_dir.name, path.name)
-                    schedule_dir_processing(parent_dir, self.loop)
+        self.debouncer.post("created", ev.src_path, ev.is_directory)
     
     def on_modified(self, ev):
-        """文件修改（写入完成）时也触发重新调度"""
-        if ev.is_directory:
-            return
-            
-        path = Path(ev.src_path)
-        if path.name.startswith('.'):
+        """文件修改（写入中）时推迟稳定检查"""
+        if not ev.is_directory:
+            self.debouncer.post("modified", ev.src_path, False)
+    
+    def on_closed(self, ev):
+        self.debouncer.post("closed", ev.src_path, ev.is_directory)
+
+class PollingWatcher(threading.Thread):
+    """轮询模式（WATCH_MODE=poll）：inotify 在 NFS/SMB 和部分 Docker Desktop 挂载上会丢事件或延迟。
+    保存每个条目的 (inode, 大小, mtime) 增量索引：目录 mtime 未变时不重新列目录，只对最近 STABLE_DELAY
+    秒内有变化的文件重新 stat，每轮开销取决于变化量而不是文件总数。发现的变化以与 StableWatcher
+    相同的事件送入 Debouncer"""
+    def __init__(self, debouncer: Debouncer, interval: float):
+        super().__init__(name="PollingWatcher", daemon=True)
+        self.debouncer = debouncer
+        self.interval = interval
+        self.dirs = {}      # 目录 → (inode, mtime_ns)，None 表示尚未列出
+        self.children = {}  # 目录 → 子条目路径集合
+        self.files = {}     # 文件 → [inode, 大小, mtime_ns, 最近一次变化的 monotonic 时间]
+        self.last_full = 0.0
+        self._halt = threading.Event()
+
+    def stop(self):
+        self._halt.set()
+
+    def run(self):
+        self._scan(initial=True)
+        while not self._halt.wait(self.interval):
+            try:
+                self._scan()
+            except Exception as e:
+                log.error(f"轮询扫描出错: {e}", exc_info=True)
+
+    def _forget(self, path: str):
+        self.files.pop(path, None)
+        self.dirs.pop(path, None)
+        for child in self.children.pop(path, ()):
+            self._forget(child)
+
+    def _list(self, d: str, now: float, full: bool, initial: bool):
+        """目录 mtime 变化（或刚变化不久、或完整扫描）时重新列目录，报告新增条目、清理已删除条目"""
+        try:
+            st = os.stat(d)
+        except FileNotFoundError:
+            self._forget(d); return
+        key = (st.st_ino, st.st_mtime_ns)
+        # mtime 精度可能只有 1 秒，刚修改过的目录下一轮仍然重新列出
+        if not full and self.dirs.get(d) == key and time.time() - st.st_mtime > 2:
             return
-            
-        # 如果是子目录中的文件被修改，重新调度
-        if path.parent != WATCH_DIR and path.parent.parent == WATCH_DIR:
-            log.debug("文件 %s 修改，重新安排目录 %s 处理", path.name, path.parent.name)
-            schedule_dir_processing(path.parent, self.loop)
+        self.dirs[d] = key
+        seen = set()
+        with os.scandir(d) as it:
+            for e in it:
+                if e.name.startswith('.'):
+                    continue  # 忽略隐藏文件（续传日志、租约等）
+                seen.add(e.path)
+                if e.is_dir(follow_symlinks=False):
+                    if d == str(WATCH_DIR) and e.path not in self.dirs:
+                        self.dirs[e.path] = None
+                        if not initial: self.debouncer.post("created", e.path, True)
+                elif e.is_file(follow_symlinks=False) and e.path not in self.files:
+                    est = e.stat()
+                    self.files[e.path] = [est.st_ino, est.st_size, est.st_mtime_ns, now]
+                    if not initial: self.debouncer.post("created", e.path, False)
+        for gone in self.children.get(d, set()) - seen:
+            self._forget(gone)
+        self.children[d] = seen
+
+    def _scan(self, initial: bool = False):
+        now = time.monotonic()
+        full = initial or now - self.last_full >= POLL_FULL_RESCAN
+        if full: self.last_full = now
+        root = str(WATCH_DIR)
+        self._list(root, now, full, initial)
+        for d in [d for d in self.dirs if d != root]:
+            self._list(d, now, full, initial)
+        # 只重新 stat 最近有变化的文件（刚列出的文件本轮已经 stat 过）
+        for path, rec in list(self.files.items()):
+            if rec[3] == now or (not full and now - rec[3] > STABLE_DELAY):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self.files.pop(path, None); continue
+            if (st.st_ino, st.st_size, st.st_mtime_ns) != tuple(rec[:3]):
+                kind = "created" if st.st_ino != rec[0] else "modified"
+                self.files[path] = [st.st_ino, st.st_size, st.st_mtime_ns, now]
+                self.debouncer.post(kind, path, False)
 
 async def main():
     WATCH_DIR.mkdir(exist_ok=True)
     log.info("启动稳定检测上传器，监视: %s", WATCH_DIR)
     log.info("逻辑：根目录单文件→单页面，根目录文件夹→等待稳定后合并页面")
-    log.info("稳定延时: %s 秒", STABLE_DELAY)
+    log.info("稳定检测: 静默期 %s~%s 秒%s，上传并发: %d", STABLE_QUIET, STABLE_DELAY,
+             f"，完成标记 {STABLE_MARKER}" if STABLE_MARKER else "", UPLOAD_WORKERS)
     
     loop = asyncio.get_running_loop()
-    event_handler = StableWatcher(loop)
-    
-    obs = Observer()
-    # 使用递归监控来检测子目录中的文件变化
-    obs.schedule(event_handler, str(WATCH_DIR), recursive=True)
+    await open_http()
+    metrics_runner = await start_metrics_server()
+    journal.open()
+    scheduler.start()
+    resume_jobs()
+    debouncer = Debouncer(loop)
+    debounce_task = asyncio.create_task(debouncer.run())
+    lease_task = asyncio.create_task(leases.run(debouncer)) if MULTI_INSTANCE else None
+    yield_task = asyncio.create_task(watch_downloads()) if YIELD_DOWNLOAD else None
+    if UPLOAD_BANDWIDTH or bandwidth.schedule or YIELD_DOWNLOAD:
+        log.info("上传带宽: 默认 %s，分时段 %s%s", f"{UPLOAD_BANDWIDTH / MB:g} MB/s" if UPLOAD_BANDWIDTH else "不限",
+                 BANDWIDTH_SCHEDULE or "无", f"，下载超过 {YIELD_DOWNLOAD / MB:g} MB/s 时让路" if YIELD_DOWNLOAD else "")
+    if WATCH_MODE == "poll":
+        log.info("监控模式: 轮询，间隔 %.1f 秒", POLL_INTERVAL)
+        obs = PollingWatcher(debouncer, POLL_INTERVAL)
+    else:
+        obs = Observer()
+        # 使用递归监控来检测子目录中的文件变化
+        obs.schedule(StableWatcher(debouncer), str(WATCH_DIR), recursive=True)
     obs.start()
+    # 与实时监控并行处理停机期间落盘的文件
+    backlog = loop.run_in_executor(None, scan_backlog, debouncer)
     
     try: 
         await asyncio.Event().wait()
     finally: 
         obs.stop(); obs.join()
-        # 清理待处理的计时器
-        for timer in pending_dirs.values():
-            timer.cancel()
+        await backlog
+        # 清理待处理的稳定检查
+        debounce_task.cancel()
+        if lease_task: lease_task.cancel()
+        if yield_task: yield_task.cancel()
+        pending_dirs.clear()
         # 清理处理锁
         processing_dirs.clear()
+        await scheduler.stop()
+        for path in list(leases.held): leases.release(path)  # 排队中的任务立即交给其他实例
+        if _opt_pool: _opt_pool.shutdown(cancel_futures=True)
+        await close_http()
+        if metrics_runner: await metrics_runner.cleanup()
+        journal.close()
 
 if __name__ == "__main__":
     try: 
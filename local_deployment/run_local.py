@@ -25,7 +25,6 @@ class LocalRunner:
         
         # 检查Python依赖
         try:
-            import notion_client
             import aiohttp
             import watchdog
             from dotenv import load_dotenv